@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import argparse
+import os
+
+from commons.log import log, log_err, log_progress
+from commons.util import (create_if_missing, delete_file, directory,
+                          filter_files, normpath)
+
+from utils import SKELETON_FORMATS, read_skeleton, save_skeleton
+
+
+def convert(src_dir, tgt_format, tgt_dir=None, delete_source=False):
+    """
+    Convert the skeleton files in `src_dir` (recursively) into the
+    `tgt_format`, keeping their relative paths inside `tgt_dir` (or
+    alongside the source files).
+    """
+    assert tgt_format in SKELETON_FORMATS, \
+        f"Invalid format: `{tgt_format}`."
+    src_dir = normpath(src_dir)
+    tgt_dir = normpath(tgt_dir) if tgt_dir else src_dir
+
+    src_files = sorted([
+        path for fmt in SKELETON_FORMATS if fmt != tgt_format
+        for path in filter_files(src_dir, ext=fmt)
+    ])
+    total = len(src_files)
+
+    for idx, src_path in enumerate(src_files):
+        base, _ = os.path.splitext(os.path.relpath(src_path, src_dir))
+        tgt_path = normpath(f"{tgt_dir}/{base}.{tgt_format}")
+
+        log_progress(idx + 1, total, base)
+
+        try:
+            data = read_skeleton(src_path)
+            create_if_missing(directory(tgt_path))
+            save_skeleton(data, tgt_path)
+
+            if delete_source:
+                delete_file(src_path)
+        except Exception as e:
+            log_err(f"   FAILED ({str(e)})", ex=e)
+    log("\nDONE", 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert skeleton files between the JSON and NPZ layouts')
+    parser.add_argument('src_dir', help='Directory of the files to convert')
+    parser.add_argument('-t', '--to', dest='tgt_format', required=True,
+                        choices=SKELETON_FORMATS, help='Target format')
+    parser.add_argument('-o', '--output_dir', dest='tgt_dir',
+                        help='Directory to write the converted files '
+                        '(defaults to the source directory)')
+    parser.add_argument('--delete_source', action='store_true',
+                        help='Delete the source files once converted')
+    args = parser.parse_args()
+    convert(args.src_dir, args.tgt_format, args.tgt_dir, args.delete_source)
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class PhonoExtactor():
     def create_result(self, value, score=None):
         from constant import CONFIDENCE_THRESHOLD
@@ -168,3 +171,338 @@ class PhonoExtactor():
         from constant import HAND_HANDSHAPE
         handshape = HAND_HANDSHAPE[hand]
         return data[handshape["start"]] or data[handshape["end"]]
+
+    # ---------------------------------------------------------------------
+    # Batch API (whole sign sequences):
+    # ---------------------------------------------------------------------
+    # Columns of the keypoints arrays:
+    X, Y, Z, SCORE = range(4)
+
+    def extract_sequence_attributes(self, data, skeleton):
+        """
+        Batch version of `extract_attributes`, for all the frames of a sign
+        at once. The `skeleton` maps each part to a tuple with the names of
+        its keypoints and an array of shape `(T, N, 4)` (columns `x`, `y`,
+        `z` and `score`), with frames sorted by index. Returns the list of
+        attributes per frame.
+        """
+        num_frames = self.__get_num_frames(skeleton)
+        hands = [
+            self.get_hand_attributes_sequence(hand, data, skeleton,
+                                              num_frames)
+            for hand in ["hand_right", "hand_left"]
+        ]
+        mouth_opening = self.get_mouth_opening_sequence(skeleton, num_frames)
+        frames_attributes = list()
+
+        for cur_index in range(num_frames):
+            attributes = dict()
+
+            for hand_attributes in hands:
+                attributes.update({
+                    name: values[cur_index]
+                    for name, values in hand_attributes.items()
+                })
+            attributes.update(
+                {"non_manual": {
+                    "mouth_opening": mouth_opening[cur_index]
+                }})
+            frames_attributes.append(attributes)
+        return frames_attributes
+
+    def get_hand_attributes_sequence(self, hand, data, skeleton, num_frames):
+        from constant import HAND_DOMINANCE
+        dom = HAND_DOMINANCE[hand]
+        movement = [None] * num_frames
+        orientation = [None] * num_frames
+        handshape = [None] * num_frames
+
+        if self.__has_handshape_action(hand, data):
+            movement = self.get_hand_movement_sequence(hand, skeleton,
+                                                       num_frames)
+            orientation = self.get_palm_orientation_sequence(
+                hand, skeleton, num_frames)
+            handshape = [
+                self.get_hand_shape(hand, data, cur_index, num_frames)
+                for cur_index in range(num_frames)
+            ]
+        return {
+            f"movement_{dom}": movement,
+            f"orientation_{dom}": orientation,
+            f"handshape_{dom}": handshape
+        }
+
+    def get_hand_movement_sequence(self, hand, skeleton, num_frames):
+        """
+        Batch version of `get_hand_movement`, with the displacements between
+        consecutive frames (there is no movement in the first one).
+        """
+        from constant import MOVE_THRESHOLD, DIRECTIONS
+        displacement = self.get_hand_displacements(hand, skeleton, num_frames)
+
+        if displacement is None:
+            return [None] * num_frames
+
+        directions = self._get_directions_sequence(displacement, DIRECTIONS,
+                                                   MOVE_THRESHOLD)
+        return [None] + self.__create_results(directions,
+                                              displacement[:, self.SCORE])
+
+    def get_palm_orientation_sequence(self, hand, skeleton, num_frames):
+        """
+        Batch version of `get_palm_orientation`, with the cross products of
+        all the frames at once.
+        """
+        from constant.constants import DIRECTIONS, ORIENTATION_THRESHOLD
+        normal = self.get_palm_normals(hand, skeleton)
+
+        if normal is None:
+            return [None] * num_frames
+
+        directions = self._get_directions_sequence(normal, DIRECTIONS,
+                                                   ORIENTATION_THRESHOLD)
+        return self.__create_results(directions, normal[:, self.SCORE])
+
+    def get_mouth_opening_sequence(self, skeleton, num_frames):
+        """
+        Batch version of `get_mouth_opening`.
+        """
+        mouth_opening = self.get_mouth_ratios(skeleton)
+
+        if mouth_opening is None:
+            return [None] * num_frames
+
+        ratios, scores = mouth_opening
+        return [
+            self.create_result(value, score)
+            for value, score in zip(ratios.tolist(), scores.tolist())
+        ]
+
+    def get_hand_displacements(self, hand, skeleton, num_frames):
+        """
+        Normalized displacements of the hand between consecutive frames, as
+        an array of shape `(T - 1, 4)`, or `None` if not available.
+        """
+        if not self.__has_keypoints(skeleton, hand) or num_frames < 2:
+            return None
+
+        base = self.__get_keypoint(skeleton, hand, "middle_finger_base")
+        return self.__normalize(self.__subtract(base[1:], base[:-1]))
+
+    def get_palm_normals(self, hand, skeleton):
+        """
+        Normalized vectors of the palm of the hand, as an array of shape
+        `(T, 4)`, or `None` if not available.
+        """
+        if not self.__has_keypoints(skeleton, hand):
+            return None
+
+        wrist = self.__get_keypoint(skeleton, hand, "wrist")
+        index_base = self.__get_keypoint(skeleton, hand, "index_finger_base")
+        pinky_base = self.__get_keypoint(skeleton, hand, "pinky_base")
+
+        if hand == "hand_right":
+            b = self.__subtract(wrist, pinky_base)
+            c = self.__subtract(wrist, index_base)
+        elif hand == "hand_left":
+            b = self.__subtract(wrist, index_base)
+            c = self.__subtract(wrist, pinky_base)
+        else:
+            raise Exception("Unknown hand")
+
+        return self.__normalize(self.__cross_product(b, c))
+
+    def get_mouth_ratios(self, skeleton):
+        """
+        Ratios of the mouth opening and their scores, as arrays of shape
+        `(T, )`, or `None` if not available.
+        """
+        from math import fsum
+
+        if not self.__has_keypoints(skeleton, "face"):
+            return None
+
+        ch_l = self.__get_keypoint(skeleton, "face", "lips_outer_left")
+        ch_r = self.__get_keypoint(skeleton, "face", "lips_outer_right")
+        ls = self.__get_keypoint(skeleton, "face", "lips_outer_top")
+        li = self.__get_keypoint(skeleton, "face", "lips_outer_bottom")
+
+        mouth_width = self.__distance(ch_l, ch_r)
+        vermilion_height = self.__distance(li, ls)
+
+        if np.any(mouth_width == 0):
+            raise ZeroDivisionError("float division by zero")
+        vermilion_height_to_mouth_width = vermilion_height / mouth_width
+
+        # Mean of the scores as in `statistics.mean` (correctly rounded):
+        scores = np.stack([kp[:, self.SCORE] for kp in [ch_l, ch_r, ls, li]],
+                          axis=-1)
+        score = [fsum(frame_scores) / 4 for frame_scores in scores.tolist()]
+        return vermilion_height_to_mouth_width, np.array(score)
+
+    # ---------------------------------------------------------------------
+    # Sweep API (grids of thresholds):
+    # ---------------------------------------------------------------------
+    def sweep_sequence_attributes(self, data, skeleton, move_thresholds,
+                                  orientation_thresholds,
+                                  confidence_thresholds):
+        """
+        Count the labels of the attributes of all the frames of a sign, for
+        all the thresholds at once. The continuous quantities (displacements,
+        palm normals and mouth ratios) are calculated only once, with the
+        `skeleton` as in `extract_sequence_attributes`.
+
+        Returns the counts per attribute, in arrays of shape `(K, C, L)` for
+        movement and orientation (`K` thresholds of the attribute, `C`
+        confidence thresholds and `L` labels of `get_direction_labels`) and
+        `(C, 2)` for the mouth opening (frames without and with it).
+        """
+        from constant import DIRECTIONS, HAND_DOMINANCE
+        num_frames = self.__get_num_frames(skeleton)
+        confidence_thresholds = np.asarray(confidence_thresholds, dtype=float)
+        counts = dict()
+
+        for hand, dom in HAND_DOMINANCE.items():
+            displacement = None
+            normal = None
+
+            if self.__has_handshape_action(hand, data):
+                displacement = self.get_hand_displacements(
+                    hand, skeleton, num_frames)
+                normal = self.get_palm_normals(hand, skeleton)
+
+            counts[f"movement_{dom}"] = self._count_directions(
+                displacement, num_frames, DIRECTIONS, move_thresholds,
+                confidence_thresholds)
+            counts[f"orientation_{dom}"] = self._count_directions(
+                normal, num_frames, DIRECTIONS, orientation_thresholds,
+                confidence_thresholds)
+
+        mouth_opening = self.get_mouth_ratios(skeleton)
+        present = np.zeros(len(confidence_thresholds), dtype=np.int64)
+
+        if mouth_opening is not None:
+            ratios, scores = mouth_opening
+            confident = scores > confidence_thresholds[:, None]
+            present = ((ratios != 0) & confident).sum(axis=1)
+        counts["mouth_opening"] = np.column_stack(
+            [num_frames - present, present])
+        return counts
+
+    def get_direction_labels(self, names):
+        """
+        Labels of the directions counted by `_count_directions`, where the
+        first one (no direction) stands for frames without the attribute.
+        """
+        from itertools import product
+        NEGATIVE, POSITIVE = 0, 1
+        options = [[None, names[axis][NEGATIVE], names[axis][POSITIVE]]
+                   for axis in ["x", "y", "z"]]
+        return [
+            "_".join([label for label in labels if label]) or None
+            for labels in product(*options)
+        ]
+
+    def _count_directions(self, vectors, num_frames, names, thresholds,
+                          confidence_thresholds):
+        """
+        Count the directions of the `vectors` for each of the `thresholds`
+        and `confidence_thresholds`, as in `_get_directions_sequence`.
+        """
+        thresholds = np.asarray(thresholds, dtype=float)[:, None]
+        confidence_thresholds = np.asarray(confidence_thresholds,
+                                           dtype=float)[:, None]
+        shape = (len(thresholds), len(confidence_thresholds),
+                 len(self.get_direction_labels(names)))
+        counts = np.zeros(shape, dtype=np.int64)
+
+        if vectors is not None and len(vectors):
+            # Index of the label of each vector, with the axes as digits
+            # (0 for no direction, 1 for negative and 2 for positive):
+            labels = 0
+            for column in [self.X, self.Y, self.Z]:
+                values = vectors[:, column]
+                labels = labels * 3 + np.where(
+                    values > thresholds, 2,
+                    np.where(values < (thresholds * -1), 1, 0))
+
+            confident = vectors[:, self.SCORE] > confidence_thresholds
+            labels = np.where(confident[None], labels[:, None], 0)
+            offsets = np.arange(shape[0] * shape[1]).reshape(
+                shape[:2] + (1, )) * shape[2]
+            counts = np.bincount((labels + offsets).ravel(),
+                                 minlength=np.prod(shape)).reshape(shape)
+
+        # Frames without the attribute (e.g., the first one for movement):
+        num_vectors = 0 if vectors is None else len(vectors)
+        counts[:, :, 0] += num_frames - num_vectors
+        return counts
+
+    def _get_directions_sequence(self, vectors, names, threshold=0.0):
+        """
+        Batch version of `_get_directions`, thresholding the axes of all the
+        `vectors` at once.
+        """
+        INDEXES = NEGATIVE, POSITIVE = 0, 1
+        axes = [(self.X, "x"), (self.Y, "y"), (self.Z, "z")]
+        labels = list()
+
+        for column, axis in axes:
+            assert len(names[axis]) == len(INDEXES), "Invalid labels size."
+            values = vectors[:, column]
+            labels.append(
+                np.select([values > threshold, values < (threshold * -1)],
+                          [names[axis][POSITIVE], names[axis][NEGATIVE]],
+                          ""))
+        return [
+            "_".join([label for label in frame_labels if label])
+            for frame_labels in zip(*[axis_labels.tolist()
+                                      for axis_labels in labels])
+        ]
+
+    def __create_results(self, values, scores):
+        return [
+            self.create_result(value, score)
+            for value, score in zip(values, scores.tolist())
+        ]
+
+    def __get_num_frames(self, skeleton):
+        return max([len(keypoints) for _, keypoints in skeleton.values()],
+                   default=0)
+
+    def __has_keypoints(self, skeleton, part):
+        names, keypoints = skeleton[part]
+        return keypoints.shape[1] > 0
+
+    def __get_keypoint(self, skeleton, part, name):
+        names, keypoints = skeleton[part]
+        return keypoints[:, names.index(name)]
+
+    def __subtract(self, a, b):
+        return np.column_stack([
+            a[:, self.X] - b[:, self.X], a[:, self.Y] - b[:, self.Y],
+            a[:, self.Z] - b[:, self.Z],
+            (a[:, self.SCORE] + b[:, self.SCORE]) / 2
+        ])
+
+    def __cross_product(self, a, b):
+        ax, ay, az, a_score = a.T
+        bx, by, bz, b_score = b.T
+        return np.column_stack([
+            ay * bz - az * by, az * bx - ax * bz, ax * by - ay * bx,
+            (a_score + b_score) / 2
+        ])
+
+    def __norm(self, a):
+        return np.sqrt(a[:, self.X]**2 + a[:, self.Y]**2 + a[:, self.Z]**2)
+
+    def __normalize(self, a):
+        norm = self.__norm(a)
+        normalized = np.zeros_like(a)
+        valid = norm != 0
+        normalized[valid, :3] = a[valid, :3] / norm[valid, None]
+        normalized[:, self.SCORE] = a[:, self.SCORE]
+        return normalized
+
+    def __distance(self, a, b):
+        return self.__norm(self.__subtract(a, b))
@@ -13,11 +13,21 @@ ARGUMENTS = [
     Argument('-f', '--format', options=["mov", "vid"], type=list, default="mov",
              help='Formats'),
     Argument('-ph', '--phases', type=list, help='Phases of pipeline'),
+    Argument('-sc', '--shared_cache_dir', type=str,
+             help='Download cache shared among work directories'),
+    Argument('-ss', '--shared_cache_size', type=float,
+             help='Maximum size (in GB) of the shared download cache'),
+    Argument('-mw', '--manifest_wal', type=bool,
+             help='Enable write-ahead logging in the work manifest'),
+    Argument('-sf', '--storage_format', options=["json", "npz"], type=str,
+             help='Format of the skeleton files'),
     Argument('-sk', '--skeleton', type=dict, help='Poses configs'),
     Argument('-sg', '--segment', type=dict, help='Split configs'),
     Argument('-dl', '--download', type=dict, help='Download configs'),
     Argument('-no', '--normalize', type=dict, help='Normalization configs'),
     Argument('-pn', '--phonology', type=dict, help='Phonology features configs'),
+    Argument('-pk', '--pack', type=dict, help='Packing configs'),
+    Argument('-ex', '--export', type=dict, help='Export configs'),
     Argument('-me', '--metadata', type=dict, help='Metadata configs')
 ]
 
@@ -26,7 +36,9 @@ PHASES = {
     "segment": p.Segmenter,
     "skeleton": p.Skeletor,
     "normalize": p.Normalizer,
-    "phonology": p.Phonologyzer
+    "phonology": p.Phonologyzer,
+    "pack": p.Packer,
+    "export": p.Exporter
 }
 
 
@@ -43,7 +55,23 @@ def run(args):
 
     last_processor = None
     total = len(metadata)
-    phases = {n: p for n, p in PHASES.items() if n in args.phases}
+    groups = [group for group, _ in metadata]
+
+    # Processors are kept across the groups, so that they can work on the
+    # next groups in background (e.g., prefetching downloads):
+    phases = {
+        name: phase(args)
+        for name, phase in PHASES.items() if name in args.phases
+    }
+    processors = dict(phases)
+    fused = dict()
+
+    # Normalized data can be handed to the phonology in memory (thus, the
+    # phonology runs along with the normalization):
+    if ("normalize" in processors) and ("phonology" in processors) and \
+            processors["normalize"].fuse_phonology:
+        fused["normalize"] = processors.pop("phonology")
+        processors["normalize"].phonologyzer = fused["normalize"]
 
     # Iterates per groups of session x scene to optimize storage consumption,
     # by processing files in batch of those groups.
@@ -53,15 +81,24 @@ def run(args):
         print_group(idx, total, session, scene)
 
         # Run pipeline:
-        for name, phase in phases.items():
-            processor = phase(args)
+        for name, processor in processors.items():
             print_phase(name, processor)
             processor.run((session, scene), rows)
+            processor.prefetch(groups[idx + 1:])
 
             # Delete the output of the last phase, if enabled:
             if last_processor:
                 last_processor.delete_output_if_enabled()
             last_processor = processor
+
+            # The phase fused into this one ran right after it:
+            if name in fused:
+                last_processor.delete_output_if_enabled()
+                last_processor = fused[name]
+
+    # Finish the work that requires all the groups:
+    for name, processor in phases.items():
+        processor.finish()
     log("\nDONE", 1)
 
 
@@ -4,3 +4,5 @@ from .skeletor import Skeletor
 from .normalizer import Normalizer
 from .metadator import Metadator
 from .phonologyzer import Phonologyzer
+from .packer import Packer
+from .exporter import Exporter
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import shutil
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 from commons.log import log, log_progress
-from commons.util import download_file, is_downloadable
-from utils import create_filename, get_valid_cam_mode_mapping
+from commons.util import (create_if_missing, delete_file, exists,
+                          filter_files, normpath, read_json, save_json)
+from utils import WorkManifest, create_filename, get_valid_cam_mode_mapping
 
 from .processor import Processor
 
@@ -19,6 +21,47 @@ class Downloader(Processor):
         self.url = self.get_arg("url")
         self.formats = self.get_arg("format")
 
+        # Prefetching of the next groups, limited to a disk budget (in GB):
+        self.prefetch_groups = self.get_arg("prefetch", 0)
+        self.disk_budget = self.get_arg("disk_budget")
+        self.prefetch_dir = normpath(
+            f"{self.work_dir}/{self.get_arg('prefetch_dir', './prefetch')}")
+        self.prefetching = dict()
+        self.reserved = 0
+        self.reserved_lock = Lock()
+
+        # Partial downloads are kept across runs, to be resumed later, and
+        # the complete ones are recorded in the manifest (size and checksum):
+        self.partial_dir = normpath(
+            f"{self.work_dir}/{self.get_arg('partial_dir', './partial')}")
+        self.manifest_path = normpath(
+            f"{self.work_dir}/"
+            f"{self.get_arg('manifest_path', './download-manifest.json')}")
+        self.verify_checksum = self.get_arg("verify_checksum", False)
+        self.manifest = (read_json(self.manifest_path)
+                         if exists(self.manifest_path) else dict())
+        self.manifest_lock = Lock()
+
+        # Results of the probes for remote files, expiring after `probe_ttl`
+        # hours (or never, if not informed):
+        self.probe_cache_path = normpath(
+            f"{self.work_dir}/"
+            f"{self.get_arg('probe_cache_path', './probe-cache.json')}")
+        self.probe_ttl = self.get_arg("probe_ttl")
+        self.probe_cache = (read_json(self.probe_cache_path)
+                            if exists(self.probe_cache_path) and
+                            not self.get_arg("invalidate_probes", False) else
+                            dict())
+        self.probe_cache_lock = Lock()
+
+        # Download cache shared among work directories (and jobs):
+        self.shared_cache = self.create_shared_cache()
+
+        # Cameras of the current group are downloaded in parallel, while the
+        # next groups are prefetched one at a time, in background:
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=1)
+
     def run(self, group, rows):
         """
         Example: http://csr.bu.edu/ftp/asl/asllvd/asl-data2/quicktime/
@@ -29,16 +72,40 @@ class Downloader(Processor):
                                             self.get_cameras(),
                                             self.output_dir)
 
+    def prefetch(self, groups):
+        """
+        Start downloading, in background, the files of the next `groups`
+        (up to the `prefetch` configured), while the other phases run.
+        """
+        for group in groups[:self.prefetch_groups]:
+            session, scene = group
+
+            if session and scene and (group not in self.prefetching):
+                self.prefetching[group] = self.prefetch_pool.submit(
+                    self.prefetch_files, group, self.url, self.get_cameras(),
+                    self.output_dir)
+
+    def finish(self):
+        # Prefetching not started yet is dropped, and the rest is awaited:
+        for future in self.prefetching.values():
+            future.cancel()
+        self.prefetch_pool.shutdown(wait=True)
+        self.pool.shutdown(wait=True)
+
     def download_files_in_metadata(self, group, urls, cameras, output_dir):
-        tempdir = tempfile.gettempdir()
         total = len(cameras)
 
         for (session, scene) in [group]:
             if session and scene:
-                cam_urls = self.select_format_to_download(
-                    session, scene, urls, cameras)
+                cam_urls = self.wait_prefetch(group)
+
+                if cam_urls is None:
+                    cam_urls = self.select_format_to_download(
+                        session, scene, urls, cameras, output_dir)
 
-                for idx, (cam, fmt_url) in enumerate(cam_urls.items()):
+                downloads = list()
+
+                for cam, fmt_url in cam_urls.items():
                     fmt = fmt_url["fmt"]
                     url = fmt_url["url"]
                     tgt_file = create_filename(session_or_sign=session,
@@ -46,40 +113,381 @@ class Downloader(Processor):
                                                camera=cam,
                                                dir=output_dir,
                                                ext=fmt)
+
+                    if self.is_downloaded(tgt_file, url):
+                        future = None
+                    else:
+                        future = self.pool.submit(self.download_camera_file,
+                                                  url, session, scene, cam,
+                                                  fmt, tgt_file)
+                    downloads.append((url, tgt_file, future))
+
+                for idx, (url, tgt_file, future) in enumerate(downloads):
                     log_progress(idx + 1, total, f"...{url[-50:]}")
 
-                    if self.output_exists(tgt_file):
+                    if future is None:
                         self.log_skipped()
                     else:
-                        # Download file:
-                        tmp_file = create_filename(session_or_sign=session,
-                                                   scene=scene,
-                                                   camera=cam,
-                                                   dir=tempdir,
-                                                   ext=fmt)
-
-                        log("    Downloading...", 2)
-                        success, e = download_file(url, tmp_file, True)
-
-                        if success:
-                            # Save file to directory:
-                            shutil.move(tmp_file, tgt_file)
-                        else:
-                            self.log_failed(e)
+                        try:
+                            log("    Downloading...", 2)
+                            future.result()
+                        except Exception as e:
+                            self.log_failed(e, [tgt_file])
+
+    def wait_prefetch(self, group):
+        """
+        Wait for the prefetching of the `group` (if any), returning the
+        formats selected for its cameras.
+        """
+        future = self.prefetching.pop(group, None)
+
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as e:
+                log(f"    Prefetch failed ({str(e)})", 2)
+        return None
+
+    def prefetch_files(self, group, urls, cameras, output_dir):
+        session, scene = group
+        cam_urls = self.select_format_to_download(session, scene, urls,
+                                                  cameras, output_dir)
+        create_if_missing(self.prefetch_dir)
+
+        for cam, fmt_url in cam_urls.items():
+            fmt = fmt_url["fmt"]
+            url = fmt_url["url"]
+            tgt_file = create_filename(session_or_sign=session,
+                                       scene=scene,
+                                       camera=cam,
+                                       dir=output_dir,
+                                       ext=fmt)
+            prefetch_file = create_filename(session_or_sign=session,
+                                            scene=scene,
+                                            camera=cam,
+                                            dir=self.prefetch_dir,
+                                            ext=fmt)
+
+            if exists(prefetch_file) or self.is_downloaded(tgt_file, url):
+                continue
+
+            # Files exceeding the budget are left to be downloaded when the
+            # group is processed:
+            size = self.get_remote_size(url)
+
+            if self.reserve(size):
+                try:
+                    self.fetch_file(url, prefetch_file)
+                finally:
+                    self.release(size)
+        return cam_urls
+
+    def reserve(self, size):
+        with self.reserved_lock:
+            if self.disk_budget is not None:
+                # Files of unknown size (e.g., no `Content-Length`) would
+                # bypass the budget, so they are not prefetched:
+                if not size:
+                    return False
+                used = self.reserved + sum([
+                    self.get_file_size(f)
+                    for f in filter_files(self.prefetch_dir)
+                ])
+                if used + size > self.disk_budget * (1024**3):
+                    return False
+            self.reserved += size
+            return True
+
+    def release(self, size):
+        with self.reserved_lock:
+            self.reserved -= size
+
+    def get_file_size(self, path):
+        import os
+        return os.path.getsize(path)
+
+    def get_remote_size(self, url):
+        from urllib.request import Request, urlopen
+
+        try:
+            with urlopen(Request(url, method="HEAD")) as response:
+                return int(response.headers.get("Content-Length", 0))
+        except Exception:
+            return 0
+
+    def download_camera_file(self, url, session, scene, cam, fmt, tgt_file):
+        prefetch_file = create_filename(session_or_sign=session,
+                                        scene=scene,
+                                        camera=cam,
+                                        dir=self.prefetch_dir,
+                                        ext=fmt)
+        self.mark_pending([tgt_file])
+
+        # Stale files are removed first, as they may be linked to the shared
+        # cache:
+        if exists(tgt_file):
+            delete_file(tgt_file)
+
+        if exists(prefetch_file):
+            shutil.move(prefetch_file, tgt_file)
+        else:
+            self.fetch_file(url, tgt_file)
+        self.mark_done(tgt_file, self.get_url_fingerprint(url))
+
+    def get_url_fingerprint(self, url):
+        # Files are produced from their URLs only:
+        return self.get_fingerprint(properties={"url": url})
+
+    def fetch_file(self, url, tgt_file):
+        from os.path import basename
+
+        # Obtain file from the shared cache, downloading it there if missing:
+        if self.shared_cache is not None:
+            entry = self.shared_cache.fetch(url, tgt_file,
+                                            self.download_resumable,
+                                            self.get_checksum)
+            self.add_to_manifest(tgt_file, url, basename(tgt_file),
+                                 entry["checksum"])
+            return
+
+        # Download file (resuming the previous attempt, if any):
+        create_if_missing(self.partial_dir)
+        part_file = normpath(f"{self.partial_dir}/{basename(tgt_file)}.part")
+        self.download_resumable(url, part_file)
+
+        # Save file to directory:
+        self.add_to_manifest(part_file, url, basename(tgt_file))
+        shutil.move(part_file, tgt_file)
+
+    def download_resumable(self, url, path):
+        """
+        Download the `url` to `path`, appending to its current content by means
+        of an HTTP range request (when supported by the server).
+
+        The validator of the remote file (ETag or Last-Modified) is kept
+        alongside the partial file, so that it is only resumed if the remote
+        file did not change (otherwise, it is downloaded again).
+        """
+        from os.path import getsize
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+
+        CHUNK_SIZE = 1024 * 1024
+        validator_path = f"{path}.validator"
+        offset = getsize(path) if exists(path) else 0
+        headers = dict()
+
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+            if exists(validator_path):
+                headers["If-Range"] = read_json(validator_path)["validator"]
+
+        try:
+            response = urlopen(Request(url, headers=headers))
+        except HTTPError as e:
+            if e.code != 416:
+                raise
+
+            # Range starting at the end of the file (already complete):
+            if offset == self.get_remote_size(url):
+                if exists(validator_path):
+                    delete_file(validator_path)
+                return
+
+            # Otherwise, the partial file does not match the remote one (e.g.,
+            # it is larger), so it is downloaded again:
+            delete_file(path)
+            if exists(validator_path):
+                delete_file(validator_path)
+            return self.download_resumable(url, path)
+
+        with response:
+            # Servers ignoring the range (or whose file changed) send the
+            # entire content:
+            if response.status != 206:
+                offset = 0
+
+            validator = self.get_validator(response.headers)
+            if validator:
+                save_json({"validator": validator}, validator_path)
+            elif exists(validator_path):
+                delete_file(validator_path)
+
+            length = response.headers.get("Content-Length")
+            expected = (offset + int(length)) if length is not None else None
+
+            with open(path, "ab" if offset else "wb") as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+
+        if (expected is not None) and (getsize(path) != expected):
+            raise Exception(f"Incomplete download ({getsize(path)} of "
+                            f"{expected} bytes)")
+        if exists(validator_path):
+            delete_file(validator_path)
+
+    def get_validator(self, headers):
+        """
+        Return the validator of the remote file for `If-Range` requests: its
+        ETag, if strong, or else its modification time.
+        """
+        etag = headers.get("ETag")
+
+        if etag and not etag.startswith("W/"):
+            return etag
+        return headers.get("Last-Modified")
+
+    def is_downloaded(self, path, url):
+        """
+        Check whether the file was downloaded from the `url` (or processed and
+        deleted, according to the work manifest) and is intact, according to
+        its size (and, optionally, checksum) in the download manifest. Files
+        missing from the download manifest are checked against the remote
+        size, and recorded.
+        """
+        from os.path import basename, getsize
+
+        if not self.output_exists(path, self.get_url_fingerprint(url)):
+            return False
+        if self.get_output_state(path) == WorkManifest.DELETED:
+            return True
+        if not exists(path):
+            return False
+
+        entry = self.manifest.get(basename(path))
+
+        if entry is None:
+            size = self.get_remote_size(url)
+
+            if size and (size != getsize(path)):
+                return False
+            self.add_to_manifest(path, url, basename(path))
+            return True
+
+        return (getsize(path) == entry["size"]) and (
+            not self.verify_checksum
+            or self.get_checksum(path) == entry["checksum"])
+
+    def add_to_manifest(self, path, url, name, checksum=None):
+        from os.path import getsize
+
+        entry = {
+            "url": url,
+            "size": getsize(path),
+            "checksum": checksum or self.get_checksum(path)
+        }
+
+        with self.manifest_lock:
+            self.manifest[name] = entry
+            save_json(self.manifest, self.manifest_path)
+
+    def get_checksum(self, path):
+        from hashlib import sha256
+
+        CHUNK_SIZE = 1024 * 1024
+        checksum = sha256()
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                checksum.update(chunk)
+        return checksum.hexdigest()
 
     def create_source_url(self, url, session, scene, camera):
         return url.format(session=session, scene=int(scene), camera=camera)
 
-    def select_format_to_download(self, session, scene, urls, cameras):
+    def select_format_to_download(self, session, scene, urls, cameras,
+                                  output_dir):
+        """
+        Select the first format available for each camera. Cameras whose file
+        is already present need no probing; for the others, the formats are
+        probed in order (unless cached), with the cameras probed concurrently.
+        """
         cam_urls = dict()
+        cam_fmt_urls = dict()
 
         for cam in cameras:
-            for fmt in self.formats:
-                url = self.create_source_url(urls[fmt],
-                                             session=session,
-                                             scene=scene,
-                                             camera=cam)
-                if is_downloadable(url):
+            fmt_urls = [(fmt,
+                         self.create_source_url(urls[fmt],
+                                                session=session,
+                                                scene=scene,
+                                                camera=cam))
+                        for fmt in self.formats]
+
+            for fmt, url in fmt_urls:
+                tgt_file = create_filename(session_or_sign=session,
+                                           scene=scene,
+                                           camera=cam,
+                                           dir=output_dir,
+                                           ext=fmt)
+                if self.output_exists(tgt_file):
                     cam_urls[cam] = {"fmt": fmt, "url": url}
                     break
+            else:
+                cam_fmt_urls[cam] = fmt_urls
+
+        if cam_fmt_urls:
+            with ThreadPoolExecutor(max_workers=len(cam_fmt_urls)) as pool:
+                available = list(
+                    pool.map(self.probe_first_available,
+                             cam_fmt_urls.values()))
+
+            for cam, fmt_url in zip(cam_fmt_urls, available):
+                if fmt_url is not None:
+                    cam_urls[cam] = {"fmt": fmt_url[0], "url": fmt_url[1]}
+
+            with self.probe_cache_lock:
+                save_json(self.probe_cache, self.probe_cache_path)
         return get_valid_cam_mode_mapping(cam_urls, self.modes)
+
+    def probe_first_available(self, fmt_urls):
+        """
+        Return the first of the `fmt_urls` (format and URL, in order of
+        priority) which is downloadable, probing them in turn until one is
+        known to exist, or `None`.
+        """
+        for fmt, url in fmt_urls:
+            if self.probe_url(url):
+                return fmt, url
+        return None
+
+    def probe_url(self, url):
+        """
+        Check whether the `url` is downloadable, unless cached (and not
+        expired). Definite answers (found, or not found/gone) are cached, but
+        not the failures to probe (e.g., network errors), as these may be
+        transient.
+        """
+        from time import time
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+
+        now = time()
+
+        with self.probe_cache_lock:
+            entry = self.probe_cache.get(url)
+
+        if entry and ((self.probe_ttl is None) or
+                      (now - entry["time"] < self.probe_ttl * 3600)):
+            return entry["exists"]
+
+        try:
+            with urlopen(Request(url, method="HEAD")):
+                available = True
+        except HTTPError as e:
+            available = False if e.code in [404, 410] else None
+        except Exception:
+            available = None
+
+        with self.probe_cache_lock:
+            if available is None:
+                self.probe_cache.pop(url, None)
+            else:
+                self.probe_cache[url] = {"exists": available, "time": now}
+
+        if not available:
+            log(f"    Not available: ...{url[-50:]}", 2)
+        return bool(available)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import math
+from collections import Counter
+from hashlib import sha256
+
+import numpy as np
+from commons.log import log, log_progress
+from commons.util import create_if_missing, delete_dir, normpath, save_json
+from constant import HAND_DOMINANCE, KEYPOINTS_COCO, PARTS
+from reader import DatasetReader
+
+from .processor import Processor
+
+
+class Exporter(Processor):
+    """
+        Processor for exporting the signs of a phase into padded arrays,
+        grouped by length and split by consultant
+    """
+    HAND_ATTRIBUTES = ["movement", "orientation", "handshape"]
+    MODE_COLUMNS = {"2d": ["x", "y", "score"], "3d": ["x", "y", "z", "score"]}
+
+    def __init__(self, args=None):
+        super().__init__('export', args)
+
+        # Sequences are padded to the next multiple of the bucket width:
+        self.bucket_width = max(1, self.get_arg("bucket_width") or 16)
+
+        # Proportions of signs per split (splits are made by consultant):
+        self.splits = self.get_arg("splits", {
+            "train": 0.8,
+            "val": 0.1,
+            "test": 0.1
+        })
+        assert (self.input_dir is not None), "Input dir must be informed"
+        assert (self.output_dir is not None), "Output dir must be informed"
+
+    def finish(self):
+        # The export requires all the signs, so it only runs at the end:
+        self.export(self.input_dir, self.output_dir, self.modes)
+
+    def export(self, input_dir, output_dir, modes):
+        log("    Indexing...")
+        # Index is kept with the export (not in the input phase's outputs):
+        create_if_missing(output_dir)
+        dataset = DatasetReader(
+            input_dir,
+            index_path=normpath(f"{output_dir}/{DatasetReader.INDEX_FILE}"),
+            refresh=True)
+        entries = [entry for entry in dataset if entry["mode"] in modes]
+
+        if not entries:
+            self.log_skipped()
+            return
+
+        labels = sorted(set([str(entry["label"]) for entry in entries]))
+        consultant_splits = self.split_by_consultant(entries)
+        is_phonology = self.is_phonology(dataset.get_data(entries[0]))
+
+        vocabulary = {"labels": labels}
+        if is_phonology:
+            vocabulary["attributes"] = {
+                name: [None]
+                for name in self.get_phonology_attributes()
+            }
+
+        index = {
+            "features": "phonology" if is_phonology else "keypoints",
+            "splits": {
+                split: sorted([
+                    consultant
+                    for consultant, s in consultant_splits.items()
+                    if s == split
+                ])
+                for split in self.splits
+            },
+            "modes": dict()
+        }
+
+        for mode in sorted(set([entry["mode"] for entry in entries])):
+            mode_dir = normpath(f"{output_dir}/{mode}")
+            delete_dir(mode_dir)
+
+            buckets = self.create_buckets(
+                [entry for entry in entries if entry["mode"] == mode],
+                consultant_splits)
+            mode_buckets = {split: list() for split in self.splits}
+            index["modes"][mode] = {"buckets": mode_buckets}
+
+            if not is_phonology:
+                index["modes"][mode]["columns"] = self.MODE_COLUMNS[mode]
+            total = len(buckets)
+
+            for bucket_idx, ((split, length), bucket) in enumerate(
+                    sorted(buckets.items())):
+                bucket_dir = normpath(f"{mode_dir}/{split}/{length:05d}")
+                log_progress(bucket_idx + 1, total,
+                             f"{mode} | {split} | length {length}")
+                log(f"    Exporting {len(bucket)} signs...")
+                create_if_missing(bucket_dir)
+
+                if is_phonology:
+                    self.export_phonology(dataset, bucket, length,
+                                          vocabulary["attributes"],
+                                          bucket_dir)
+                else:
+                    self.export_keypoints(dataset, bucket, length, mode,
+                                          bucket_dir)
+
+                self.save_array(
+                    np.array([entry["frames"] for entry in bucket],
+                             dtype=np.int32), f"{bucket_dir}/lengths.npy")
+                self.save_array(
+                    np.array([labels.index(str(entry["label"]))
+                              for entry in bucket], dtype=np.int64),
+                    f"{bucket_dir}/labels.npy")
+                save_json([entry["basename"] for entry in bucket],
+                          f"{bucket_dir}/basenames.json")
+
+                mode_buckets[split].append({
+                    "length": length,
+                    "count": len(bucket),
+                    "dir": f"{mode}/{split}/{length:05d}"
+                })
+
+        save_json(vocabulary, normpath(f"{output_dir}/vocabulary.json"))
+        save_json(index, normpath(f"{output_dir}/index.json"))
+
+    def split_by_consultant(self, entries):
+        """
+        Assign the consultants to the splits deterministically (in the order
+        of the hashes of their names), approximating the proportions of signs
+        configured for the splits.
+        """
+        counts = Counter([str(entry["consultant"]) for entry in entries])
+        consultants = sorted(
+            counts, key=lambda c: sha256(c.encode("utf-8")).hexdigest())
+
+        # Number of signs up to the end of each split:
+        names = list(self.splits)
+        total_ratio = sum(self.splits.values())
+        limits = np.cumsum([
+            self.splits[name] / total_ratio * len(entries) for name in names
+        ])
+
+        # Each consultant goes to the split in which the middle of its signs
+        # falls, when they are laid out in order:
+        assigned = dict()
+        num_signs = 0
+
+        for consultant in consultants:
+            middle = num_signs + counts[consultant] / 2
+            split_idx = min(int(np.searchsorted(limits, middle, side="right")),
+                            len(names) - 1)
+            assigned[consultant] = names[split_idx]
+            num_signs += counts[consultant]
+        return assigned
+
+    def create_buckets(self, entries, consultant_splits):
+        """
+        Group the entries by split and length, rounded up to the bucket
+        width.
+        """
+        buckets = dict()
+
+        for entry in entries:
+            split = consultant_splits[str(entry["consultant"])]
+            length = math.ceil(max(1, entry["frames"]) /
+                               self.bucket_width) * self.bucket_width
+            buckets.setdefault((split, length), list()).append(entry)
+        return buckets
+
+    def export_keypoints(self, dataset, entries, length, mode, bucket_dir):
+        """
+        Export the keypoints of the signs into an array of shape `(S, T, K,
+        C)`, with the parts concatenated in the order of `PARTS` and the
+        columns of the `mode`.
+        """
+        columns = self.MODE_COLUMNS[mode]
+        num_keypoints = sum([len(KEYPOINTS_COCO[part]) for part in PARTS])
+        features = np.lib.format.open_memmap(
+            f"{bucket_dir}/features.npy", mode="w+", dtype=np.float32,
+            shape=(len(entries), length, num_keypoints, len(columns)))
+
+        for idx, entry in enumerate(entries):
+            _, _, parts = dataset.get_arrays(entry)
+
+            for names, part_columns, _ in parts.values():
+                if names and (part_columns != columns):
+                    raise Exception(f"Incompatible columns for the sign "
+                                    f"`{entry['basename']}`: {part_columns}.")
+
+            features[idx, :entry["frames"]] = self.stack_keypoints(
+                parts, entry["frames"], len(columns))
+        features.flush()
+
+    def stack_keypoints(self, parts, num_frames, num_columns):
+        """
+        Concatenate the keypoints of the `parts` into an array of shape
+        `(T, K, C)`, in the order of `KEYPOINTS_COCO` (missing ones are
+        zero).
+        """
+        keypoints = list()
+
+        for part in PARTS:
+            names = KEYPOINTS_COCO[part]
+            values = np.zeros((num_frames, len(names), num_columns))
+
+            if (part in parts) and parts[part][0]:
+                part_names, _, part_values = parts[part]
+                indexes = {name: i for i, name in enumerate(names)}
+                values[:, [indexes[name] for name in part_names]] = \
+                    part_values
+            keypoints.append(values)
+        return np.concatenate(keypoints, axis=1)
+
+    def export_phonology(self, dataset, entries, length, vocabulary,
+                         bucket_dir):
+        """
+        Export the attributes of the signs into an array of shape `(S, T, A)`
+        with the ids of the values in the `vocabulary` (0 for none), and the
+        mouth opening into an array of shape `(S, T)`.
+        """
+        attributes = self.get_phonology_attributes()
+        features = np.lib.format.open_memmap(
+            f"{bucket_dir}/features.npy", mode="w+", dtype=np.int32,
+            shape=(len(entries), length, len(attributes)))
+        mouth_opening = np.lib.format.open_memmap(
+            f"{bucket_dir}/mouth_opening.npy", mode="w+", dtype=np.float32,
+            shape=(len(entries), length))
+
+        for idx, entry in enumerate(entries):
+            data = dataset.get_data(entry)
+            frames = sorted(data["frames"], key=lambda x: x["frame_index"])
+
+            for t, frame in enumerate(frames):
+                phonology = frame["phonology"]
+
+                for a, name in enumerate(attributes):
+                    result = phonology.get(name)
+
+                    if result:
+                        features[idx, t, a] = self.get_id(
+                            vocabulary[name], result["value"])
+
+                result = (phonology.get("non_manual")
+                          or {}).get("mouth_opening")
+                if result:
+                    mouth_opening[idx, t] = result["value"]
+
+        features.flush()
+        mouth_opening.flush()
+
+    def get_phonology_attributes(self):
+        return [
+            f"{attribute}_{dom}" for dom in HAND_DOMINANCE.values()
+            for attribute in self.HAND_ATTRIBUTES
+        ]
+
+    def get_id(self, values, value):
+        if value not in values:
+            values.append(value)
+        return values.index(value)
+
+    def is_phonology(self, data):
+        return any(["phonology" in frame for frame in data["frames"]])
+
+    def save_array(self, array, path):
+        np.save(path, array)
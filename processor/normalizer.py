@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 from itertools import product
 
+import numpy as np
 from commons.log import log, log_progress
-from commons.util import exists
 from commons.util.io_util import (create_if_missing, delete_file, directory,
-                                  normpath, read_json, save_json)
+                                  normpath)
 from constant import PARTS_OPENPOSE_MAPPING
-from utils import create_filename
+from utils import (SKELETON_FORMATS, create_filename, find_skeleton_file,
+                   read_skeleton, save_skeleton)
 
 from .processor import Processor
 
@@ -16,91 +17,179 @@ class Normalizer(Processor):
         Preprocessor for normalizing skeleton coordinates
     """
     COORDS_MODE = {"2d": ["x", "y"], "3d": ["x", "y", "z"]}
+    REFERENCES = ["frame", "median", "mean"]
+    FINGERPRINT_ARGS = ["reference"]
 
     def __init__(self, args=None):
         super().__init__('normalize', args)
         self.mode = self.get_arg("mode")
 
+        # Distance of reference: per frame, or for the whole sequence
+        # (median or mean of the frames where both shoulders were found):
+        self.reference = self.get_arg("reference", "frame")
+        assert self.reference in self.REFERENCES, \
+            f"Invalid `reference`: `{self.reference}`."
+
+        # Phonologyzer to hand the normalized data in memory, if fused:
+        self.fuse_phonology = self.get_arg("fuse_phonology", False)
+        self.phonologyzer = None
+
+        # Format of the output files (input files are read in any format):
+        self.storage_format = self.get_arg("storage_format", "json")
+        assert self.storage_format in SKELETON_FORMATS, \
+            f"Invalid `storage_format`: `{self.storage_format}`."
+
     def run(self, group, rows):
         if not rows.empty:
             self.process_normalization(rows, self.mode, self.input_dir,
                                        self.output_dir)
 
+            if self.phonologyzer:
+                self.phonologyzer.save_sweep()
+
     def process_normalization(self, rows, modes, input_dir, output_dir):
         rows_modes = product(rows.itertuples(), modes)
         total = len(rows.index) * len(modes)
 
         for row_idx, (row, mode) in enumerate(rows_modes):
-            src_path = create_filename(base=row.basename,
-                                       dir=normpath(f"{input_dir}/{mode}"),
-                                       ext="json")
+            src_path = find_skeleton_file(row.basename,
+                                          normpath(f"{input_dir}/{mode}"))
             tgt_path = create_filename(base=row.basename,
                                        dir=normpath(f"{output_dir}/{mode}"),
-                                       ext="json")
+                                       ext=self.storage_format)
 
             log_progress(row_idx + 1, total, f"{row.basename} ({mode})")
 
-            if not exists(src_path) or self.output_exists(tgt_path):
+            # Outputs are produced again when stale (their inputs or config
+            # changed):
+            fingerprint = self.get_fingerprint(
+                [src_path]) if src_path else None
+            phono_fingerprint = self.phonologyzer.create_fingerprint(
+                [fingerprint]) if (self.phonologyzer and fingerprint) else None
+
+            # When fused, normalized data is only saved if the output is to
+            # be kept (otherwise, it would be deleted anyway):
+            save_normalized = (self.phonologyzer is None) or \
+                (not self.delete_on_finish)
+            pending_normalized = save_normalized and \
+                not self.output_exists(tgt_path, fingerprint)
+            phono_path = self.phonologyzer.get_target_path(
+                row, mode) if self.phonologyzer else None
+            pending_phono = (phono_path is not None) and \
+                not self.phonologyzer.output_exists(phono_path,
+                                                    phono_fingerprint)
+
+            if src_path is None or not (pending_normalized or pending_phono):
                 self.log_skipped()
             else:
                 log("    Normalizing...")
-                data = read_json(src_path)
+                data = read_skeleton(src_path)
+
+                if pending_normalized:
+                    self.mark_pending([tgt_path])
+                if pending_phono:
+                    self.phonologyzer.mark_pending([phono_path])
 
                 try:
                     # Normalize and save data:
-                    data["frames"] = [
-                        self.normalize_frame(frame, mode)
-                        for frame in data["frames"]
-                    ]
-                    create_if_missing(directory(tgt_path))
-                    save_json(data, tgt_path)
+                    data["frames"] = self.normalize_frames(
+                        data["frames"], mode)
+
+                    if pending_normalized:
+                        create_if_missing(directory(tgt_path))
+                        save_skeleton(data, tgt_path)
+                        self.mark_done(tgt_path, fingerprint)
+
+                    # Extract phonology from the normalized data in memory:
+                    if pending_phono:
+                        log("    Processing attributes...")
+                        self.phonologyzer.save_attributes(
+                            data, phono_path, mode, phono_fingerprint)
                 except Exception as e:
-                    self.log_failed(e)
-                    delete_file(tgt_path)
+                    self.log_failed(e,
+                                    [tgt_path] if pending_normalized else [])
+
+                    # Normalized output is only discarded if produced now:
+                    if pending_normalized:
+                        delete_file(tgt_path)
+                    if pending_phono:
+                        self.phonologyzer.mark_failed([phono_path])
+
+    def normalize_frames(self, frames, mode):
+        """
+        Normalize the coordinates of all the `frames` at once, dividing them
+        by the distance of reference.
+        """
+        if not frames:
+            return frames
 
-    def normalize_frame(self, frame, mode):
-        ref_distance = self.get_ref_distance(frame, mode)
+        ref_distance = self.get_ref_distance(frames, mode)
 
         for part in PARTS_OPENPOSE_MAPPING.values():
-            if isinstance(frame['skeleton'][part], dict):
+            if all([isinstance(frame['skeleton'][part], dict)
+                    for frame in frames]):
                 for coord in self.COORDS_MODE[mode]:
-                    if coord in frame['skeleton'][part]:
-                        frame['skeleton'][part][coord] = list(
-                            frame['skeleton'][part][coord] / ref_distance)
-        return frame
+                    if all([coord in frame['skeleton'][part]
+                            for frame in frames]):
+                        values = self.stack_values(frames, part, coord)
+                        values = values / ref_distance
 
-    def get_ref_distance(self, frame, mode):
+                        for frame, frame_values in zip(frames, values):
+                            frame['skeleton'][part][coord] = \
+                                frame_values.tolist()
+        return frames
+
+    def stack_values(self, frames, part, coord):
         """
-        Calculate distance of reference, based on the distance between
-        shoulders.
+        Stack the `coord` values of the `part` of all the `frames` in an array
+        of shape `(T, N)`.
         """
-        from commons.model import Coordinate
-
-        def get_coordinate(part, mode, idx, name):
-            coords = self.COORDS_MODE[mode]
-            x = part["x"][idx] if ("x" in coords) else 0
-            y = part["y"][idx] if ("y" in coords) else 0
-            z = part["z"][idx] if ("z" in coords) else 0
-            return Coordinate(x, y, z, part["score"][idx], name=name)
+        values = [frame['skeleton'][part][coord] for frame in frames]
 
-        # Find indexes:
-        body = frame["skeleton"]["body"]
-        idx_left_shoulder = body["name"].index("shoulder_left")
-        idx_right_shoulder = body["name"].index("shoulder_right")
-
-        # Find shoulders:
-        left_shoulder = get_coordinate(body, mode, idx_left_shoulder,
-                                       "left_shoulder")
-        right_shoulder = get_coordinate(body, mode, idx_right_shoulder,
-                                        "right_shoulder")
-
-        # Validate shoulders:
-        if left_shoulder.is_zero():
-            raise Exception(
-                "Could not find a `left shoulder` for normalizing skeleton.")
-        elif right_shoulder.is_zero():
+        if len(set([len(v) for v in values])) > 1:
             raise Exception(
-                "Could not find a `right shoulder` for normalizing skeleton.")
+                f"Inconsistent number of keypoints for the '{part}'.")
+        return np.array(values, dtype=float).reshape(len(frames), -1)
 
-        # Calculate distance:
-        return right_shoulder.dist_to(left_shoulder)
+    def get_ref_distance(self, frames, mode):
+        """
+        Calculate distance of reference, based on the distance between
+        shoulders. This is an array of shape `(T, 1)` (one distance per
+        frame) or a scalar (for the whole sequence), according to the
+        `reference` configured.
+        """
+        # Find indexes:
+        names = frames[0]["skeleton"]["body"]["name"]
+        idx_left_shoulder = names.index("shoulder_left")
+        idx_right_shoulder = names.index("shoulder_right")
+
+        # Find shoulders, with shape `(T, coords)`:
+        body = np.stack([
+            self.stack_values(frames, "body", coord)
+            for coord in self.COORDS_MODE[mode]
+        ], axis=-1)
+        left_shoulder = body[:, idx_left_shoulder]
+        right_shoulder = body[:, idx_right_shoulder]
+        found = np.any(left_shoulder != 0, axis=1) & np.any(
+            right_shoulder != 0, axis=1)
+
+        # Calculate distances:
+        distances = np.sqrt(
+            np.sum((right_shoulder - left_shoulder)**2, axis=1))
+
+        if self.reference == "frame":
+            # Validate shoulders:
+            if not np.all(np.any(left_shoulder != 0, axis=1)):
+                raise Exception("Could not find a `left shoulder` for "
+                                "normalizing skeleton.")
+            elif not np.all(np.any(right_shoulder != 0, axis=1)):
+                raise Exception("Could not find a `right shoulder` for "
+                                "normalizing skeleton.")
+            return distances[:, None]
+        else:
+            # Validate shoulders:
+            if not np.any(found):
+                raise Exception("Could not find both shoulders in any frame "
+                                "for normalizing skeleton.")
+            reduce_fn = np.median if self.reference == "median" else np.mean
+            return reduce_fn(distances[found])
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+from itertools import product
+from os.path import normpath
+
+from commons.log import log, log_progress
+from commons.util import create_if_missing, directory
+from utils import (ShardStore, WorkManifest, create_filename,
+                   find_skeleton_file)
+
+from .processor import Processor
+
+
+class Packer(Processor):
+    """
+        Processor for packing the per-sign files of a phase into shards
+        (or unpacking them back)
+    """
+    def __init__(self, args=None):
+        super().__init__('pack', args)
+
+        # Unpack the shards in `input_dir` into per-sign files, instead:
+        self.unpack = self.get_arg("unpack", False)
+
+        shards_dir = self.input_dir if self.unpack else self.output_dir
+        assert (shards_dir is not None), "Shards directory must be informed"
+        self.store = ShardStore(shards_dir, self.get_arg("shard_size", 1024))
+
+        # Fraction of the shards left unused (by files packed again) from
+        # which these are compacted (never, if not informed):
+        self.compact_threshold = self.get_arg("compact_threshold", None)
+
+    def run(self, group, rows):
+        if not rows.empty:
+            process_fn = (self.unpack_files
+                          if self.unpack else self.pack_files)
+            process_fn(rows, self.modes, self.input_dir, self.output_dir)
+
+    def finish(self):
+        if self.unpack or (self.compact_threshold is None):
+            return
+        unused_size = self.store.get_unused_size()
+
+        if unused_size and \
+                (unused_size / self.store.get_size() > self.compact_threshold):
+            log(f"Compacting shards ({unused_size / (1024**2):.1f} MB "
+                "unused)...", 1)
+            self.store.compact()
+
+    def list_outputs(self):
+        # Shards are not outputs of the signs (these are recorded as packed):
+        return super().list_outputs() if self.unpack else []
+
+    def delete_output_if_enabled(self):
+        # Shards are kept, as they are the outputs of all signs:
+        if self.unpack:
+            super().delete_output_if_enabled()
+
+    def get_key(self, row, mode):
+        return f"{mode}/{row.basename}".lower()
+
+    def pack_files(self, rows, modes, input_dir, output_dir):
+        rows_modes = product(rows.itertuples(), modes)
+        total = len(rows.index) * len(modes)
+        packed, failed = list(), list()
+
+        for row_idx, (row, mode) in enumerate(rows_modes):
+            src_path = find_skeleton_file(row.basename,
+                                          normpath(f"{input_dir}/{mode}"))
+            key = self.get_key(row, mode)
+
+            log_progress(row_idx + 1, total, f"{row.basename} ({mode})")
+
+            if (src_path is None) or self.is_packed(key, src_path):
+                self.log_skipped()
+            else:
+                log("    Packing...")
+                try:
+                    # Stale files are appended again (and indexed instead of
+                    # the previous ones):
+                    self.store.add(key, src_path)
+                    self.store.get_entry(key)["fingerprint"] = \
+                        self.get_fingerprint([src_path])
+                    packed.append((key, row.basename, mode))
+                except Exception as e:
+                    self.log_failed(e)
+                    failed.append((key, row.basename, mode))
+
+        # Index is saved (and the signs recorded) once per group:
+        self.store.save_index()
+        self.record_states(packed, WorkManifest.DONE)
+        self.record_states(failed, WorkManifest.FAILED)
+
+    def record_states(self, signs, state):
+        """
+        Record the `state` of the `signs` (as tuples of `(key, basename,
+        mode)`) in the work manifest, as items of their modes rather than the
+        shard files.
+        """
+        items = list()
+
+        for key, basename, mode in signs:
+            entry = self.store.get_entry(key) if key in self.store else {}
+            item = create_filename(base=basename, ext=entry.get("ext"))
+            items.append((item, mode, entry.get("size"),
+                          entry.get("fingerprint")))
+
+        if items:
+            self.work_manifest.set_states(self.phase_name, items, state)
+
+    def is_packed(self, key, src_path):
+        # Files packed before the fingerprints are taken as current:
+        return (key in self.store) and (
+            self.store.get_entry(key).get("fingerprint")
+            in [None, self.get_fingerprint([src_path])])
+
+    def unpack_files(self, rows, modes, input_dir, output_dir):
+        rows_modes = product(rows.itertuples(), modes)
+        total = len(rows.index) * len(modes)
+
+        for row_idx, (row, mode) in enumerate(rows_modes):
+            key = self.get_key(row, mode)
+
+            log_progress(row_idx + 1, total, f"{row.basename} ({mode})")
+
+            if key not in self.store:
+                self.log_skipped()
+                continue
+
+            tgt_path = create_filename(base=row.basename,
+                                       dir=normpath(f"{output_dir}/{mode}"),
+                                       ext=self.store.get_entry(key)["ext"])
+
+            fingerprint = self.create_fingerprint(
+                [self.store.get_entry(key).get("fingerprint")])
+
+            if self.output_exists(tgt_path, fingerprint):
+                self.log_skipped()
+            else:
+                log("    Unpacking...")
+                create_if_missing(directory(tgt_path))
+                self.store.extract(key, tgt_path)
+                self.mark_done(tgt_path, fingerprint)
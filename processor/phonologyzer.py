@@ -2,13 +2,13 @@
 from itertools import product
 from os.path import normpath
 
+import numpy as np
 from commons.log import log, log_progress
-from commons.util import (create_if_missing, directory, exists, read_json,
-                          save_json)
-from constant import PARTS
+from commons.util import create_if_missing, directory, save_json
+from constant import DIRECTIONS, PARTS
 from extractor import PhonoExtactor
 from reader import AsllvdSkeletonReader
-from utils import create_filename
+from utils import create_filename, find_skeleton_file, read_skeleton
 
 from .processor import Processor
 
@@ -20,42 +20,245 @@ class Phonologyzer(Processor):
     def __init__(self, args=None):
         super().__init__('phonology', args)
 
+        # Grid of thresholds to sweep, instead of extracting the attributes
+        # (label counts per mode are summarized in the sweep file):
+        self.sweep = self.get_arg("sweep")
+        self.sweep_path = normpath(
+            f"{self.work_dir}/"
+            f"{self.get_arg('sweep_path', './phonology-sweep.json')}")
+        self.sweep_counts = dict()
+
     def run(self, group, rows):
         if not rows.empty:
             self.process_attributes(rows, self.modes, self.input_dir,
                                     self.output_dir)
+            self.save_sweep()
 
     def process_attributes(self, rows, modes, input_dir, output_dir):
         rows_modes = product(rows.itertuples(), modes)
         total = len(rows.index) * len(modes)
 
         for row_idx, (row, mode) in enumerate(rows_modes):
-            src_path = create_filename(base=row.basename,
-                                       dir=normpath(f"{input_dir}/{mode}"),
-                                       ext="json")
-            tgt_path = create_filename(base=row.basename,
-                                       dir=normpath(f"{output_dir}/{mode}"),
-                                       ext="json")
+            src_path = find_skeleton_file(row.basename,
+                                          normpath(f"{input_dir}/{mode}"))
+            tgt_path = self.get_target_path(row, mode, output_dir)
+
+            fingerprint = self.get_fingerprint(
+                [src_path]) if src_path else None
 
             log_progress(row_idx + 1, total, f"{row.basename} ({mode})")
 
-            if not exists(src_path) or self.output_exists(tgt_path):
+            if (src_path is None) or self.output_exists(tgt_path, fingerprint):
                 self.log_skipped()
             else:
                 log("    Processing attributes...")
+                self.mark_pending([tgt_path])
                 data = self.read_data(src_path)
-                data = self.extract_attributes(data)
+                self.save_attributes(data, tgt_path, mode, fingerprint)
+
+    def output_exists(self, path, fingerprint=None):
+        # Sweeps do not write the attributes, so no sign is skipped:
+        return (not self.sweep) and super().output_exists(path, fingerprint)
+
+    def mark_pending(self, paths):
+        # Nor are the states of the signs changed by sweeps:
+        if not self.sweep:
+            super().mark_pending(paths)
+
+    def mark_failed(self, paths):
+        if not self.sweep:
+            super().mark_failed(paths)
+
+    def get_config(self):
+        from constant import (CONFIDENCE_THRESHOLD, MOVE_THRESHOLD,
+                              ORIENTATION_THRESHOLD)
+
+        # Attributes depend on the thresholds of the extraction:
+        config = super().get_config()
+        config.update({
+            "move_threshold": MOVE_THRESHOLD,
+            "orientation_threshold": ORIENTATION_THRESHOLD,
+            "confidence_threshold": CONFIDENCE_THRESHOLD
+        })
+        return config
+
+    def get_target_path(self, row, mode, output_dir=None):
+        output_dir = output_dir or self.output_dir
+        return create_filename(base=row.basename,
+                               dir=normpath(f"{output_dir}/{mode}"),
+                               ext="json")
+
+    def save_attributes(self, data, tgt_path, mode, fingerprint=None):
+        if self.sweep:
+            self.sweep_attributes(data, mode)
+            return
+
+        data = self.extract_attributes(data)
 
-                # Write output:
-                create_if_missing(directory(tgt_path))
-                save_json(data, tgt_path)
+        # Write output:
+        create_if_missing(directory(tgt_path))
+        save_json(data, tgt_path)
+        self.mark_done(tgt_path, fingerprint)
 
-    def read_data(self, path, person=0):
-        content = read_json(path)
+    def read_data(self, path):
+        return read_skeleton(path)
+
+    def parse_data(self, content, person=0):
+        """
+        Parse the skeleton `content` into keypoints by body part, which create
+        their coordinates when accessed.
+        """
         reader = AsllvdSkeletonReader(content, PARTS)
         return reader.get_data(person)
 
     def extract_attributes(self, data):
+        """
+        Extract the attributes of all the frames at once, from the keypoints
+        stacked into arrays. Frames with inconsistent number of keypoints
+        are extracted frame by frame instead.
+        """
+        frames = sorted(data["frames"], key=lambda x: x["frame_index"])
+        skeleton = self.stack_skeleton(frames)
+
+        if skeleton is None:
+            return self.extract_attributes_per_frame(self.parse_data(data))
+
+        extractor = PhonoExtactor()
+        attributes = extractor.extract_sequence_attributes(data, skeleton)
+
+        def replace_skeleton(frame, frame_attributes):
+            new_frame = {
+                key: value
+                for key, value in frame.items() if key != "skeleton"
+            }
+            new_frame["phonology"] = frame_attributes
+            return new_frame
+
+        data = dict(data)
+        data["frames"] = [
+            replace_skeleton(frame, frame_attributes)
+            for frame, frame_attributes in zip(frames, attributes)
+        ]
+        return data
+
+    def stack_skeleton(self, frames):
+        """
+        Stack the keypoints of the `frames` per part, into arrays of shape
+        `(T, N, 4)` (columns `x`, `y`, `z` and `score`), along with their
+        names. Returns `None` if the number of keypoints is inconsistent.
+        """
+        COLUMNS = ["x", "y", "z", "score"]
+        skeleton = dict()
+
+        for part in PARTS:
+            parts = [frame["skeleton"][part] for frame in frames]
+            names = parts[0]["name"] if parts else []
+
+            if any([p["name"] != names for p in parts]):
+                return None
+
+            columns = [
+                np.array([p.get(column) or [0] * len(names) for p in parts],
+                         dtype=float).reshape(len(parts), len(names))
+                for column in COLUMNS
+            ]
+            skeleton[part] = (names, np.stack(columns, axis=-1))
+        return skeleton
+
+    def get_sweep_thresholds(self):
+        from constant import (CONFIDENCE_THRESHOLD, MOVE_THRESHOLD,
+                              ORIENTATION_THRESHOLD)
+        defaults = {
+            "move_threshold": MOVE_THRESHOLD,
+            "orientation_threshold": ORIENTATION_THRESHOLD,
+            "confidence_threshold": CONFIDENCE_THRESHOLD
+        }
+        return {
+            name: list(self.sweep.get(name) or [default])
+            for name, default in defaults.items()
+        }
+
+    def sweep_attributes(self, data, mode):
+        """
+        Count the labels of the attributes of the sign for every combination
+        of thresholds, accumulating them per mode.
+        """
+        frames = sorted(data["frames"], key=lambda x: x["frame_index"])
+        skeleton = self.stack_skeleton(frames)
+
+        if skeleton is None:
+            self.log_failed(
+                Exception("Inconsistent keypoints among the frames"))
+            return
+
+        thresholds = self.get_sweep_thresholds()
+        counts = PhonoExtactor().sweep_sequence_attributes(
+            data, skeleton, thresholds["move_threshold"],
+            thresholds["orientation_threshold"],
+            thresholds["confidence_threshold"])
+
+        if mode not in self.sweep_counts:
+            self.sweep_counts[mode] = {"signs": 0, "frames": 0, "counts": {}}
+        mode_counts = self.sweep_counts[mode]
+        mode_counts["signs"] += 1
+        mode_counts["frames"] += len(frames)
+
+        for name, values in counts.items():
+            if name in mode_counts["counts"]:
+                mode_counts["counts"][name] += values
+            else:
+                mode_counts["counts"][name] = values
+
+    def save_sweep(self):
+        """
+        Save the summary of the sweep, with the label counts per combination
+        of thresholds, for the signs swept so far.
+        """
+        if not self.sweep or not self.sweep_counts:
+            return
+
+        thresholds = self.get_sweep_thresholds()
+        labels = PhonoExtactor().get_direction_labels(DIRECTIONS)
+        summary = dict()
+
+        def count_labels(labels, values):
+            return {(label or "none"): count
+                    for label, count in zip(labels, values.tolist())
+                    if count}
+
+        for mode, mode_counts in self.sweep_counts.items():
+            combinations = list()
+            indexes = product(*[enumerate(values)
+                                for values in thresholds.values()])
+
+            for (m, move), (o, orientation), (c, confidence) in indexes:
+                counts = dict()
+
+                for name, values in mode_counts["counts"].items():
+                    if name.startswith("movement"):
+                        counts[name] = count_labels(labels, values[m, c])
+                    elif name.startswith("orientation"):
+                        counts[name] = count_labels(labels, values[o, c])
+                    else:
+                        counts[name] = count_labels(["none", "present"],
+                                                    values[c])
+                combinations.append({
+                    "move_threshold": move,
+                    "orientation_threshold": orientation,
+                    "confidence_threshold": confidence,
+                    "counts": counts
+                })
+
+            summary[mode] = {
+                "signs": mode_counts["signs"],
+                "frames": mode_counts["frames"],
+                "combinations": combinations
+            }
+
+        create_if_missing(directory(self.sweep_path))
+        save_json(summary, self.sweep_path)
+
+    def extract_attributes_per_frame(self, data):
         extractor = PhonoExtactor()
         frames = data["frames"]
         total_frames = len(frames)
@@ -1,6 +1,11 @@
+import json
+import os
+from hashlib import sha256
+from threading import Lock
+
 from commons.log import log, log_err
 from commons.util import create_if_missing, exists, normpath, save_args
-from utils import ArgsReader, get_cameras
+from utils import ArgsReader, SharedCache, WorkManifest, get_cameras
 
 
 class Processor:
@@ -10,12 +15,17 @@ class Processor:
 
     MODE_CAMERAS = {"2d": [1], "3d": [1, 2]}
 
+    # Config of the phase which its outputs depend on (outputs are produced
+    # again when it changes):
+    FINGERPRINT_ARGS = []
+
     def __init__(self, phase_name, args):
         self.args_reader = ArgsReader(args, phase_name)
         self.phase_name = phase_name
         self.work_dir = normpath(self.get_arg("work_dir"))
         self.delete_on_finish = self.get_arg("delete_on_finish", False)
         self.modes = self.get_arg("mode")
+        self.workers = max(1, self.get_arg("workers") or 1)
 
         # Workdir:
         assert (self.work_dir is not None), "Workdir must be informed"
@@ -32,6 +42,12 @@ class Processor:
         if self.output_dir:
             create_if_missing(self.output_dir)
 
+        # States of the items of the phase, read in bulk when first needed:
+        self.work_manifest = WorkManifest(self.work_dir,
+                                          self.get_arg("manifest_wal", False))
+        self.__states = None
+        self.__states_lock = Lock()
+
     def __try_get_as_path(self, attr):
         value = self.get_arg(attr)
 
@@ -45,6 +61,16 @@ class Processor:
     def get_cameras(self):
         return get_cameras(self.modes)
 
+    def create_shared_cache(self):
+        """
+        Create the download cache shared among work directories, if enabled.
+        """
+        cache_dir = self.get_arg("shared_cache_dir")
+
+        if cache_dir is None:
+            return None
+        return SharedCache(cache_dir, self.get_arg("shared_cache_size"))
+
     def is_debug(self):
         return self.get_arg("debug", False)
 
@@ -54,29 +80,249 @@ class Processor:
     def run(self, group, rows):
         pass
 
+    def prefetch(self, groups):
+        """
+        Hook to start working, in background, on the next `groups`.
+        """
+        pass
+
+    def finish(self):
+        """
+        Hook to work on all the groups, once they were processed.
+        """
+        pass
+
     def log_skipped(self):
         log("    Skipped")
 
-    def log_failed(self, e):
+    def log_failed(self, e, paths=None):
         log_err(f"   FAILED ({str(e)})", ex=e)
 
-    def __get_del_path(self, path):
-        path = normpath(path, path_as_str=False)
-        return normpath(f"{path.parent}/{path.stem}.del")
+        if paths:
+            self.mark_failed(paths)
+
+    def get_item(self, path, dir=None):
+        """
+        Return the item of the output in `path` (relative to the output
+        directory, or to `dir`, or to that of its mode) and its mode (empty
+        if none).
+        """
+        rel_path = os.path.relpath(
+            normpath(path), dir or self.output_dir
+            or self.work_dir).replace(os.sep, "/")
+        mode, _, item = rel_path.partition("/")
+
+        if item and (mode in self.MODE_CAMERAS):
+            return item, mode
+        return rel_path, ""
+
+    def get_output_path(self, item, mode=""):
+        return normpath(f"{self.output_dir}/{mode}/{item}")
+
+    def get_output_state(self, path):
+        """
+        Return the state of the output in `path` in the work manifest, or
+        `None` if unknown.
+        """
+        return self.__get_record(path)[2]
+
+    def output_exists(self, path, fingerprint=None):
+        """
+        Check whether the output in `path` was produced (even if deleted
+        afterwards) and, when the `fingerprint` is informed, whether it was
+        produced from the same inputs and config.
+        """
+        item, mode, state, recorded = self.__get_record(path)
+
+        if state not in [WorkManifest.DONE, WorkManifest.DELETED]:
+            return False
+        if (fingerprint is None) or (fingerprint == recorded):
+            return True
+
+        # Outputs produced before the fingerprints are taken as current:
+        if recorded is None:
+            self.__get_states()[(item, mode)] = (state, fingerprint)
+            self.work_manifest.set_states(self.phase_name,
+                                          [(item, mode, None, fingerprint)],
+                                          state)
+            return True
+        return False
+
+    def mark_pending(self, paths):
+        self.__set_states(paths, WorkManifest.PENDING)
+
+    def mark_done(self, path, fingerprint=None):
+        self.__set_states([path], WorkManifest.DONE, fingerprint)
+
+    def mark_failed(self, paths):
+        self.__set_states(paths, WorkManifest.FAILED)
+
+    def get_config(self):
+        """
+        Return the config of the phase which its outputs depend on (as per
+        `FINGERPRINT_ARGS`).
+        """
+        return {name: self.get_arg(name) for name in self.FINGERPRINT_ARGS}
+
+    def get_fingerprint(self, inputs=(), properties=None):
+        """
+        Return the fingerprint of an output produced from the `inputs` (paths
+        in the input directory) and with the `properties` (e.g., metadata of
+        the sign), under the config of the phase.
+        """
+        return self.create_fingerprint(
+            [self.get_input_fingerprint(path) for path in inputs],
+            properties)
+
+    def create_fingerprint(self, input_fingerprints=(), properties=None):
+        content = json.dumps(
+            {
+                "config": self.get_config(),
+                "properties": properties,
+                "inputs": list(input_fingerprints)
+            },
+            sort_keys=True,
+            default=str)
+        return sha256(content.encode("utf-8")).hexdigest()
+
+    def get_input_fingerprint(self, path):
+        """
+        Return the fingerprint of the input in `path`: that recorded by the
+        phase which produced it or, if unknown, its size and modification
+        time (`None` if missing).
+        """
+        input_phase = self.get_input_phase()
 
-    def output_exists(self, path):
-        del_path = self.__get_del_path(path)
-        return exists(path) or exists(del_path)
+        if input_phase is not None:
+            item, mode = self.get_item(path, self.input_dir)
+            fingerprint = self.work_manifest.get_fingerprint(
+                item, input_phase, mode)
+
+            if fingerprint is not None:
+                return fingerprint
+
+        if not exists(path):
+            return None
+
+        stat = os.stat(path)
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    def get_input_phase(self):
+        """
+        Return the phase whose output directory is the input directory of this
+        phase, if any.
+        """
+        if self.input_dir is None:
+            return None
+
+        for name, section in self.args_reader.args.items():
+            if isinstance(section, dict) and (name != self.phase_name) and \
+                    section.get("output_dir") and normpath(
+                        f"{self.work_dir}/{section['output_dir']}"
+                    ) == self.input_dir:
+                return name
+        return None
+
+    def __get_record(self, path):
+        """
+        Return the item of the output in `path`, its mode, and its state and
+        fingerprint in the work manifest (`None` if unknown).
+        """
+        states = self.__get_states()
+        item, mode = self.get_item(path)
+
+        # Outputs deleted before the manifest are recorded without extension:
+        for key in [(item, mode), (os.path.splitext(item)[0], mode)]:
+            if key in states:
+                return (*key, *states[key])
+        return item, mode, None, None
+
+    def __set_states(self, paths, state, fingerprint=None):
+        states = self.__get_states()
+        items = list()
+
+        for path in paths:
+            item, mode = self.get_item(path)
+            size = (self.__get_size(path)
+                    if state == WorkManifest.DONE else None)
+            _, last_fingerprint = states.get((item, mode), (None, None))
+            states[(item, mode)] = (state, fingerprint or last_fingerprint)
+            items.append((item, mode, size, fingerprint))
+
+        if items:
+            self.work_manifest.set_states(self.phase_name, items, state)
+
+    def __get_states(self):
+        with self.__states_lock:
+            if self.__states is None:
+                states = self.work_manifest.get_states(self.phase_name)
+
+                # Outputs of the runs before the manifest are recorded once:
+                if (not states) and self.output_dir:
+                    self.__record_outputs()
+                    states = self.work_manifest.get_states(self.phase_name)
+                self.__states = states
+        return self.__states
+
+    def __record_outputs(self):
+        """
+        Record the outputs found in the output directory (files or
+        directories, per mode) as done, and those marked with `.del` files
+        (by previous versions) as deleted.
+        """
+        done, deleted = list(), list()
+
+        for path in self.list_outputs():
+            item, mode = self.get_item(path)
+
+            if path.endswith(".del"):
+                deleted.append((os.path.splitext(item)[0], mode, None, None))
+            else:
+                done.append((item, mode, self.__get_size(path), None))
+
+        self.work_manifest.set_states(self.phase_name, done,
+                                      WorkManifest.DONE)
+        self.work_manifest.set_states(self.phase_name, deleted,
+                                      WorkManifest.DELETED)
+
+    def list_outputs(self):
+        """
+        Return the paths of the outputs in the output directory (per mode).
+        """
+        if not exists(self.output_dir):
+            return []
+
+        paths = list()
+
+        for entry in os.scandir(self.output_dir):
+            if entry.is_dir() and (entry.name in self.MODE_CAMERAS):
+                paths.extend([e.path for e in os.scandir(entry.path)])
+            else:
+                paths.append(entry.path)
+        return paths
+
+    def __get_size(self, path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        return sum([
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(path) for f in files
+        ])
 
     def delete_output_if_enabled(self):
-        from commons.util import delete_file, filter_files, save_items
+        from commons.util import delete_dir, delete_file
 
         if self.delete_on_finish and self.output_dir:
-            all_files = set(filter_files(self.output_dir))
-            del_files = set(filter_files(self.output_dir, ext="del"))
-            new_files = all_files - del_files
-
-            for f in new_files:
-                del_path = self.__get_del_path(f)
-                save_items([], del_path)
-                delete_file(f)
+            paths = [
+                self.get_output_path(item, mode)
+                for (item, mode), (state, _) in self.__get_states().items()
+                if state == WorkManifest.DONE
+            ]
+
+            for path in paths:
+                if os.path.isdir(path):
+                    delete_dir(path)
+                elif exists(path):
+                    delete_file(path)
+
+            self.__set_states(paths, WorkManifest.DELETED)
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 import shutil
 import tempfile
+from threading import Lock
 
 from commons.log import log, log_progress
 from commons.util import (create_if_missing, delete_dir, execute_command,
-                          exists, filename, normpath)
-from utils import create_filename, get_camera_files_if_all_matched
+                          exists, filename, filter_files, normpath)
+from reader import VidReader
+from utils import (ArgsReader, create_filename,
+                   get_camera_files_if_all_matched, link_or_copy)
 
 from .processor import Processor
 
@@ -14,6 +17,7 @@ class Segmenter(Processor):
     """
         Preprocessor for splitting original videos
     """
+    FINGERPRINT_ARGS = ["fps_in", "fps_out"]
 
     def __init__(self, args=None):
         super().__init__('segment', args)
@@ -21,6 +25,15 @@ class Segmenter(Processor):
         self.fps_out = self.get_arg("fps_out")
         self.formats = self.get_arg("format")
         self.vidreader_path = self.get_arg("vidreader_path")
+        self.vid_decoder = self.get_arg("vid_decoder", "vidreader")
+        assert self.vid_decoder in ["vidreader", "mmap"], \
+            f"Invalid `vid_decoder`: `{self.vid_decoder}`."
+        self.vid_readers = dict()
+        self.vid_readers_lock = Lock()
+
+        # Missing videos are restored from the shared download cache:
+        self.shared_cache = self.create_shared_cache()
+        self.download_urls = ArgsReader(args, "download").get_arg("url")
 
     def run(self, group, rows):
         if not rows.empty:
@@ -28,62 +41,260 @@ class Segmenter(Processor):
                               self.output_dir)
 
     def split_videos(self, rows, input_dir, cameras, output_dir):
-        tempdir = tempfile.gettempdir()
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Temporary directory is exclusive to this run, so that concurrent
+        # runs (and workers) do not interfere with each other:
+        tempdir = tempfile.mkdtemp(prefix="segment-")
         total = len(rows.index) * len(cameras)
+        count = 0
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                # Frames are extracted once per scene x camera, and then
+                # shared among all the signs of the scene that need them:
+                scene_cams = self.get_scene_cams(rows, input_dir, cameras,
+                                                 tempdir, output_dir)
+                splits = [(scene_cam, self.submit_split(pool, scene_cam))
+                          for scene_cam in scene_cams]
+
+                for scene_cam, split_futures in splits:
+                    try:
+                        self.wait_split(split_futures)
+                        share_futures = self.submit_share(
+                            pool, scene_cam, tempdir, output_dir)
+
+                        for row, future in share_futures:
+                            count += 1
+                            log_progress(
+                                count, total,
+                                f"{row.basename} (cam {scene_cam['cam']:02.0f})"
+                                f" ({scene_cam['fmt']})")
 
-        for row_idx, row in enumerate(rows.itertuples()):
+                            if future is None:
+                                self.log_skipped()
+                            else:
+                                try:
+                                    future.result()
+                                except Exception as e:
+                                    self.log_failed(e)
+                    finally:
+                        delete_dir(scene_cam["store_dir"])
+        finally:
+            self.close_vid_readers()
+            delete_dir(tempdir)
+
+    def get_scene_cams(self, rows, input_dir, cameras, tempdir, output_dir):
+        scene_cams = list()
+
+        for (session, scene), scene_rows in rows.groupby(["session",
+                                                          "scene"]):
+            self.restore_from_shared_cache(session, scene, scene_rows,
+                                           cameras, input_dir, output_dir)
             camera_files = get_camera_files_if_all_matched(
-                session_or_sign=row.session,
-                scene=row.scene,
+                session_or_sign=session,
+                scene=scene,
                 formats=self.formats,
                 cameras=cameras,
                 modes=self.modes,
                 dir=input_dir)
 
-            for cam_idx, (cam, fmt_path) in enumerate(camera_files.items()):
-                fmt = fmt_path["fmt"]
-                path = fmt_path["path"]
-                tgt_path = create_filename(base=row.basename,
-                                           camera=cam,
-                                           dir=output_dir)
-
-                log_progress((len(cameras) * row_idx) + (cam_idx + 1),
-                             total, f"{row.basename} (cam {cam:02.0f}) ({fmt})")
-
-                # Splits only if the file is not already present:
-                if self.output_exists(tgt_path):
-                    self.log_skipped()
-                else:
-                    tmp_path = create_filename(base=row.basename,
-                                               camera=cam,
-                                               dir=tempdir)
-                    create_if_missing(tmp_path)
-                    prefix = filename(tmp_path)
-
-                    log(f"    Segmenting frames "
-                        f"[{row.frame_start:.0f} ~ {row.frame_end:.0f}] ", 2)
+            for cam, fmt_path in camera_files.items():
+                store_dir = create_filename(session_or_sign=session,
+                                            scene=scene,
+                                            camera=cam,
+                                            dir=tempdir)
+                rows_frames = self.get_pending_frames(scene_rows, cam,
+                                                      fmt_path["fmt"],
+                                                      fmt_path["path"],
+                                                      output_dir)
+                self.mark_pending([
+                    create_filename(base=basename, camera=cam, dir=output_dir)
+                    for basename in rows_frames
+                ])
+                scene_cams.append({
+                    "cam": cam,
+                    "fmt": fmt_path["fmt"],
+                    "path": fmt_path["path"],
+                    "rows": scene_rows,
+                    "rows_frames": rows_frames,
+                    "store_dir": store_dir,
+                    "store_prefix": filename(store_dir)
+                })
+        return scene_cams
 
-                    try:
-                        # Split file in temporary diretory:
-                        self.split_video(path, tmp_path, fmt, prefix,
-                                         row.frame_start, row.frame_end,
-                                         self.fps_in, self.fps_out)
-
-                        # Save file to target directory:
-                        shutil.move(tmp_path, tgt_path)
-                    except Exception as e:
-                        self.log_failed(e)
-                        delete_dir(tmp_path)
-
-    def split_video(self, input_path, output_dir, fmt, prefix, frame_start,
-                    frame_end, fps_in, fps_out):
-        from math import ceil, floor
+    def restore_from_shared_cache(self, session, scene, rows, cameras,
+                                  input_dir, output_dir):
+        """
+        Restore, from the shared download cache, the videos missing in the
+        `input_dir` for the cameras with signs to segment.
+        """
+        if (self.shared_cache is None) or (self.download_urls is None):
+            return
 
-        ROUND_BASE = 10.0
+        for cam in cameras:
+            paths = {
+                fmt: create_filename(session_or_sign=session,
+                                     scene=int(scene),
+                                     camera=cam,
+                                     dir=input_dir,
+                                     ext=fmt)
+                for fmt in self.formats
+            }
+            # Signs already segmented from any of the videos need none:
+            if any([exists(path) for path in paths.values()]) or \
+                    not all([self.get_pending_frames(rows, cam, fmt, path,
+                                                     output_dir)
+                             for fmt, path in paths.items()]):
+                continue
+
+            for fmt, path in paths.items():
+                url = self.download_urls[fmt].format(session=session,
+                                                     scene=int(scene),
+                                                     camera=cam)
+                if self.shared_cache.restore(url, path) is not None:
+                    break
+
+    def submit_split(self, pool, scene_cam):
+        """
+        Submit the segmentation of all the frames needed by the signs of the
+        scene, split into units of work according to the format.
+        """
+        rows_frames = scene_cam["rows_frames"]
+        futures = list()
+
+        if rows_frames:
+            frames = sorted(set().union(*rows_frames.values()))
+            log(f"    Segmenting frames (cam {scene_cam['cam']:02.0f}) "
+                f"[{frames[0]:.0f} ~ {frames[-1]:.0f}] ", 2)
+            create_if_missing(scene_cam["store_dir"])
+
+            for unit in self.split_units(scene_cam["fmt"], frames):
+                futures.append(
+                    pool.submit(self.split_video, scene_cam["path"],
+                                scene_cam["store_dir"], scene_cam["fmt"],
+                                scene_cam["store_prefix"], unit))
+        return futures
+
+    def split_units(self, fmt, frames):
+        """
+        Split the `frames` into units of work. While `.mov` files are decoded
+        sequentially (thus in a single unit), `.vid` frames can be read at
+        random and, therefore, are distributed among the workers.
+        """
+        if fmt == "vid":
+            size = -(-len(frames) // self.workers)
+            return [frames[i:i + size] for i in range(0, len(frames), size)]
+        return [frames]
+
+    def wait_split(self, futures):
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                self.log_failed(e)
+
+    def submit_share(self, pool, scene_cam, tempdir, output_dir):
+        rows_frames = scene_cam["rows_frames"]
+        futures = list()
+
+        for row in scene_cam["rows"].itertuples():
+            if row.basename in rows_frames:
+                fingerprint = self.get_row_fingerprint(
+                    row, scene_cam["fmt"], scene_cam["path"])
+                future = pool.submit(self.share_frames, row,
+                                     scene_cam["cam"], scene_cam["store_dir"],
+                                     scene_cam["store_prefix"],
+                                     rows_frames[row.basename], fingerprint,
+                                     tempdir, output_dir)
+            else:
+                future = None
+            futures.append((row, future))
+        return futures
+
+    def get_pending_frames(self, rows, cam, fmt, video_path, output_dir):
+        """
+        Obtain the frames to segment per sign, considering only the signs
+        whose output is not already present (or is stale, as per the video
+        in `video_path`).
+        """
+        rows_frames = dict()
+
+        for row in rows.itertuples():
+            tgt_path = create_filename(base=row.basename,
+                                       camera=cam,
+                                       dir=output_dir)
+
+            if not self.output_exists(
+                    tgt_path, self.get_row_fingerprint(row, fmt, video_path)):
+                rows_frames[row.basename] = self.get_frames(
+                    row.frame_start, row.frame_end, self.fps_in,
+                    self.fps_out)
+        return rows_frames
+
+    def get_row_fingerprint(self, row, fmt, video_path):
+        # Signs depend on the video (as downloaded) and how it is decoded:
+        return self.get_fingerprint(
+            [video_path], {
+                "frame_start": row.frame_start,
+                "frame_end": row.frame_end,
+                "format": fmt,
+                "vid_decoder": self.vid_decoder if fmt == "vid" else None
+            })
+
+    def share_frames(self, row, cam, store_dir, store_prefix, frames,
+                     fingerprint, tempdir, output_dir):
+        tgt_path = create_filename(base=row.basename,
+                                   camera=cam,
+                                   dir=output_dir)
+        tmp_path = create_filename(base=row.basename,
+                                   camera=cam,
+                                   dir=tempdir)
+        create_if_missing(tmp_path)
+        prefix = filename(tmp_path)
+
+        try:
+            # Link the frames of the sign in temporary diretory:
+            for frame in frames:
+                src_path = self.create_frame_path(store_dir, store_prefix,
+                                                  frame)
+                if not exists(src_path):
+                    raise Exception(f"Failed to segment frame {frame}")
+                link_or_copy(src_path,
+                             self.create_frame_path(tmp_path, prefix, frame))
+
+            # Save file to target directory (replacing the stale one):
+            delete_dir(tgt_path)
+            shutil.move(tmp_path, tgt_path)
+            self.mark_done(tgt_path, fingerprint)
+        except Exception:
+            delete_dir(tmp_path)
+            self.mark_failed([tgt_path])
+            raise
+
+    def split_video(self, input_path, output_dir, fmt, prefix, frames):
         FORMAT_SPLIT_FN = {
             "mov": self.split_mov,
-            "vid": self.split_vid
+            "vid": (self.split_vid_mmap
+                    if self.vid_decoder == "mmap" else self.split_vid)
+        }
+        fn = FORMAT_SPLIT_FN[fmt]
+        args = {
+            "input_path": input_path,
+            "output_dir": output_dir,
+            "prefix": prefix,
+            "frames": frames
         }
+        fn(**args)
+
+    def get_frames(self, frame_start, frame_end, fps_in, fps_out):
+        """
+        Obtain the indexes of the frames to be segmented, rounded to the
+        `ROUND_BASE` and sampled according to the `fps_out`.
+        """
+        from math import ceil, floor
+
+        ROUND_BASE = 10.0
 
         if frame_end is None:
             frame_end = frame_start
@@ -91,26 +302,51 @@ class Segmenter(Processor):
         frame_start = int(floor(frame_start / ROUND_BASE) * ROUND_BASE)
         frame_end = int(ceil(frame_end / ROUND_BASE) * ROUND_BASE)
         step = int(fps_in / fps_out)
+        return list(range(frame_start, (frame_end + 1), step))
 
-        for frame in range(frame_start, (frame_end + 1), step):
-            fn = FORMAT_SPLIT_FN[fmt]
-            output_path = f"{output_dir}/{prefix}_{frame:05d}.ppm"
-            args = {
-                "input_path": input_path,
-                "output_path": output_path,
-                "frame": frame
-            }
-            fn(**args)
+    def get_frame_runs(self, frames):
+        """
+        Group the (sorted) `frames` into runs of `(start, end, step)`, in which
+        consecutive frames are evenly spaced.
+        """
+        runs = list()
+
+        for frame in sorted(set(frames)):
+            if runs:
+                start, end, step = runs[-1]
+
+                if (step is None) or (frame - end == step):
+                    runs[-1] = (start, frame, frame - end)
+                    continue
+            runs.append((frame, frame, None))
+        return [(start, end, step or 1) for (start, end, step) in runs]
 
-            if not exists(output_path):
-                raise Exception(f"Failed to segment frame {frame}")
+    def create_frame_path(self, output_dir, prefix, frame):
+        return f"{output_dir}/{prefix}_{frame:05d}.ppm"
 
-    def split_mov(self, input_path, output_path, frame):
+    def split_mov(self, input_path, output_dir, prefix, frames):
+        """
+        Segment all the `frames` from the `.mov` file with a single decoding
+        pass, instead of spawning one FFmpeg process per frame.
+        """
         from ffmpy import FFmpeg
+
+        frames = sorted(set(frames))
+        select = "+".join([
+            f"between(n\\,{start}\\,{end})*not(mod(n-{start}\\,{step}))"
+            for (start, end, step) in self.get_frame_runs(frames)
+        ])
+
+        # FFmpeg numbers the selected frames sequentially, thus they are
+        # renamed to their original indexes afterwards:
+        seq_path = f"{output_dir}/{prefix}-seq_%05d.ppm"
         input_args = {input_path: None}
         output_args = {
-            output_path: [
-                "-vf", f"select='between(n\\,{frame}\\,{frame})'",
+            seq_path: [
+                "-vf", f"select='{select}'",
+                "-vsync", "0",
+                "-frames:v", str(len(frames)),
+                "-start_number", "0",
                 "-hide_banner",
                 "-loglevel", "error"
             ]
@@ -118,13 +354,72 @@ class Segmenter(Processor):
         ff = FFmpeg(inputs=input_args, outputs=output_args)
         ff.run()
 
-    def split_vid(self, input_path, output_path, frame):
+        for seq, frame in enumerate(frames):
+            seq_file = seq_path % seq
+
+            if exists(seq_file):
+                shutil.move(seq_file,
+                            self.create_frame_path(output_dir, prefix, frame))
+
+    def split_vid(self, input_path, output_dir, prefix, frames):
+        """
+        Segment the `frames` from the `.vid` file, with a single `vidReader`
+        invocation per run of evenly spaced frames.
+        """
         executable = normpath(self.vidreader_path)
         assert exists(
             executable), f"Failed to locate `vidReader` at `{executable}`."
 
-        args = [input_path, output_path, frame]
-        success, _, e = execute_command(executable, args)
+        # `vidReader` appends its file name pattern to the output directory
+        # argument in place, overwriting the beginning of the next argument
+        # (the prefix). Thus, frames are written to an exclusive directory,
+        # with a prefix long enough to preserve the frame arguments, and then
+        # renamed after their frame numbers:
+        run_dir = tempfile.mkdtemp(prefix="vid-", dir=output_dir)
+        run_prefix = prefix.ljust(16, "_")
+
+        try:
+            for (start, end, step) in self.get_frame_runs(frames):
+                # Arguments: input, output dir, prefix, first frame, last
+                # frame, and the step as the ratio 'fps_in / fps_out':
+                args = [input_path, run_dir, run_prefix, start, end, step, 1]
+                success, _, e = execute_command(executable, args)
+
+                if not success:
+                    raise e
+
+            for path in filter_files(run_dir, ext="ppm"):
+                frame = int(filename(path, False).split("_")[-1])
+                shutil.move(path,
+                            self.create_frame_path(output_dir, prefix, frame))
+        finally:
+            delete_dir(run_dir)
+
+    def split_vid_mmap(self, input_path, output_dir, prefix, frames):
+        """
+        Segment the `frames` from the `.vid` file in-process, with the
+        memory-mapped `VidReader` (shared by the workers and the signs).
+        """
+        reader = self.get_vid_reader(input_path)
+
+        for frame in sorted(set(frames)):
+            path = self.create_frame_path(output_dir, prefix, frame)
+
+            # As in `vidReader`, frames before the first one are blank, and
+            # those after the last one are not segmented:
+            if frame < 1:
+                reader.save_image(reader.get_blank_frame(), path)
+            elif frame <= len(reader):
+                reader.save_frame(frame, path)
+
+    def get_vid_reader(self, path):
+        with self.vid_readers_lock:
+            if path not in self.vid_readers:
+                self.vid_readers[path] = VidReader(path)
+            return self.vid_readers[path]
 
-        if not success:
-            raise e
+    def close_vid_readers(self):
+        with self.vid_readers_lock:
+            for reader in self.vid_readers.values():
+                reader.close()
+            self.vid_readers.clear()
@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
-import copy
 import tempfile
 
+import numpy as np
 from commons.log import log, log_progress
 from commons.util import (create_if_missing, delete_dir, directory,
                           execute_command, exists, filename, filter_files,
                           normpath, read_json, save_json)
 from constant import KEYPOINTS_COCO, PARTS_OPENPOSE_MAPPING
-from utils import create_filename, get_camera_dirs_if_all_matched
+from utils import (SKELETON_FORMATS, create_filename,
+                   get_camera_dirs_if_all_matched, link_or_copy,
+                   save_skeleton_arrays)
 
 from .processor import Processor
 
@@ -20,6 +22,10 @@ class Skeletor(Processor):
     KEYPOINTS = KEYPOINTS_COCO
     SKELETON_MODEL = "COCO"
 
+    # Columns of the coordinates arrays, per mode:
+    COLUMNS_2D = ["x", "y", "score"]
+    COLUMNS_3D = ["x", "y", "z", "score"]
+
     def __init__(self, argv=None):
         super().__init__('skeleton', argv)
 
@@ -32,60 +38,152 @@ class Skeletor(Processor):
         self.model_path = normpath(self.get_arg("models_dir"))
         assert exists(self.model_path), "Path to OpenPose models is not valid."
 
-    def run(self, group, rows):
-        tempdir = tempfile.gettempdir()
-        snippets_dir = normpath(f"{tempdir}/snippets")
-        create_if_missing(snippets_dir)
-
-        if not rows.empty:
-            self.process_videos(rows, self.input_dir,
-                                snippets_dir, self.output_dir,
-                                self.get_cameras(), self.modes)
+        # Estimate all the signs of the scene in a single OpenPose run:
+        self.batch = self.get_arg("batch", False)
 
-    def process_videos(self, rows, input_dir, snippets_dir, output_dir,
-                       cameras, modes):
-        total = len(rows.index)
+        # Number of threads for reading the snippets:
+        self.read_workers = max(1, self.get_arg("read_workers") or 8)
 
-        for row_idx, row in enumerate(rows.itertuples()):
-            # Log current:
-            log_progress(row_idx + 1, total, row.basename)
+        # Format of the output files:
+        self.storage_format = self.get_arg("storage_format", "json")
+        assert self.storage_format in SKELETON_FORMATS, \
+            f"Invalid `storage_format`: `{self.storage_format}`."
 
-            # Create target paths per mode:
-            mode_paths = {
-                mode: create_filename(base=row.basename,
-                                      dir=normpath(f"{output_dir}/{mode}"),
-                                      ext="json")
-                for mode in modes
-            }
-            mode_paths = {
-                mode: path
-                for mode, path in mode_paths.items()
-                if not self.output_exists(path)
-            }
+    def run(self, group, rows):
+        if not rows.empty:
+            process_fn = (self.process_videos_batched
+                          if self.batch else self.process_videos)
+            process_fn(rows, self.input_dir, self.output_dir,
+                       self.get_cameras(), self.modes)
 
-            # Get valid input files per camera:
-            camera_dirs = get_camera_dirs_if_all_matched(basename=row.basename,
-                                                         scene=row.scene,
-                                                         cameras=cameras,
-                                                         modes=self.modes,
-                                                         dir=input_dir)
+    def process_videos(self, rows, input_dir, output_dir, cameras, modes):
+        from concurrent.futures import ThreadPoolExecutor
 
-            if (not mode_paths) or (not camera_dirs):
-                self.log_skipped()
-            else:
-                try:
-                    create_if_missing(snippets_dir)
+        total = len(rows.index)
 
-                    # Estimate skeletons/snippets:
-                    cam_snippets = self.estimate_snippets(
-                        camera_dirs, snippets_dir)
+        # Snippets are written to directories exclusive to each sign and
+        # camera, so that concurrent estimations (and runs) do not interfere
+        # with each other:
+        tempdir = tempfile.mkdtemp(prefix="skeleton-")
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                rows_tasks = list()
+
+                for row in rows.itertuples():
+                    mode_paths, camera_dirs = self.get_row_paths(
+                        row, input_dir, output_dir, cameras, modes)
+
+                    if (not mode_paths) or (not camera_dirs):
+                        snippets_dir, futures = None, None
+                    else:
+                        # Estimate skeletons/snippets:
+                        snippets_dir = tempfile.mkdtemp(dir=tempdir)
+                        futures = self.estimate_snippets(
+                            pool, camera_dirs, snippets_dir)
+                    rows_tasks.append((row, mode_paths, snippets_dir, futures))
+
+                for row_idx, (row, mode_paths, snippets_dir,
+                              futures) in enumerate(rows_tasks):
+                    # Log current:
+                    log_progress(row_idx + 1, total, row.basename)
+
+                    if futures is None:
+                        self.log_skipped()
+                    else:
+                        try:
+                            cam_snippets = {
+                                cam: future.result()
+                                for cam, future in futures.items()
+                            }
+
+                            # Pack snippets and save:
+                            self.pack_and_save_snippets(
+                                cam_snippets, mode_paths, row)
+                        except Exception as e:
+                            self.log_failed(e, mode_paths.values())
+                        finally:
+                            delete_dir(snippets_dir)
+        finally:
+            delete_dir(tempdir)
+
+    def process_videos_batched(self, rows, input_dir, output_dir, cameras,
+                               modes):
+        """
+        Estimate the frames of all the signs of the scene in a single OpenPose
+        run per camera (thus loading the models only once), and then split
+        the snippets back per sign.
+        """
+        total = len(rows.index)
+        rows_paths = [(row, *self.get_row_paths(row, input_dir, output_dir,
+                                                cameras, modes))
+                      for row in rows.itertuples()]
+        rows_camera_dirs = {
+            row.basename: camera_dirs
+            for (row, mode_paths, camera_dirs) in rows_paths
+            if mode_paths and camera_dirs
+        }
+        cam_snippets_dirs = dict()
+        error = None
+        tempdir = tempfile.mkdtemp(prefix="skeleton-")
 
-                    # Pack snippets and save:
-                    self.pack_and_save_snippets(cam_snippets, mode_paths, row)
+        try:
+            # Estimate skeletons/snippets:
+            if rows_camera_dirs:
+                try:
+                    cam_snippets_dirs = self.estimate_snippets_batched(
+                        rows_camera_dirs, tempdir)
                 except Exception as e:
-                    self.log_failed(e)
-                finally:
-                    delete_dir(snippets_dir)
+                    error = e
+
+            for row_idx, (row, mode_paths,
+                          camera_dirs) in enumerate(rows_paths):
+                # Log current:
+                log_progress(row_idx + 1, total, row.basename)
+
+                if row.basename not in rows_camera_dirs:
+                    self.log_skipped()
+                elif error:
+                    self.log_failed(error, mode_paths.values())
+                else:
+                    try:
+                        # Pack snippets and save:
+                        cam_snippets = {
+                            cam: self.get_snippets(cam_snippets_dirs[cam],
+                                                   filename(_dir, False))
+                            for cam, _dir in camera_dirs.items()
+                        }
+                        self.pack_and_save_snippets(cam_snippets,
+                                                    mode_paths, row)
+                    except Exception as e:
+                        self.log_failed(e, mode_paths.values())
+        finally:
+            delete_dir(tempdir)
+
+    def get_row_paths(self, row, input_dir, output_dir, cameras, modes):
+        # Create target paths per mode:
+        mode_paths = {
+            mode: create_filename(base=row.basename,
+                                  dir=normpath(f"{output_dir}/{mode}"),
+                                  ext=self.storage_format)
+            for mode in modes
+        }
+        mode_paths = {
+            mode: path
+            for mode, path in mode_paths.items()
+            if not self.output_exists(path,
+                                      self.get_row_fingerprint(row, mode))
+        }
+
+        # Get valid input files per camera:
+        camera_dirs = get_camera_dirs_if_all_matched(basename=row.basename,
+                                                     scene=row.scene,
+                                                     cameras=cameras,
+                                                     modes=self.modes,
+                                                     dir=input_dir)
+        if camera_dirs:
+            self.mark_pending(mode_paths.values())
+        return mode_paths, camera_dirs
 
     def get_distinct_items(self, files_properties):
         from itertools import islice
@@ -119,19 +217,70 @@ class Skeletor(Processor):
             "mode": mode
         }
 
-    def estimate_snippets(self, camera_dirs, snippets_dir):
-        cam_snippets = dict()
-
-        for cam, _dir in camera_dirs.items():
-            log(f"   Estimating (cam {cam:02.0f})...")
-            self.run_openpose(_dir, snippets_dir)
+    def estimate_snippets(self, pool, camera_dirs, snippets_dir):
+        """
+        Submit the estimation of the cameras to the `pool`, each one writing
+        to its own directory inside `snippets_dir`.
+        """
+        return {
+            cam: pool.submit(self.estimate_camera, cam, _dir,
+                             tempfile.mkdtemp(dir=snippets_dir))
+            for cam, _dir in camera_dirs.items()
+        }
 
-            basename = filename(_dir, False)
-            snippets = sorted(
-                filter_files(snippets_dir, name=f"{basename}*", ext="json"))
-            assert (len(snippets) > 0), "Failed to estimate snippets."
-            cam_snippets[cam] = snippets
-        return cam_snippets
+    def estimate_camera(self, cam, dir, snippets_dir):
+        log(f"   Estimating (cam {cam:02.0f})...")
+        self.run_openpose(dir, snippets_dir)
+        return self.get_snippets(snippets_dir, filename(dir, False))
+
+    def estimate_snippets_batched(self, rows_camera_dirs, tempdir):
+        """
+        Estimate the snippets of all the rows at once, per camera, gathering
+        their frames in a single directory (frames are named after the rows,
+        so are their snippets). Cameras are estimated concurrently, and the
+        directory of the snippets of each one is returned.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        cameras = sorted(
+            set([
+                cam for camera_dirs in rows_camera_dirs.values()
+                for cam in camera_dirs
+            ]))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {
+                cam: pool.submit(self.estimate_camera_batched, cam,
+                                 rows_camera_dirs, tempdir)
+                for cam in cameras
+            }
+            return {cam: future.result() for cam, future in futures.items()}
+
+    def estimate_camera_batched(self, cam, rows_camera_dirs, tempdir):
+        batch_dir = tempfile.mkdtemp(prefix=f"batch-cam{cam:02.0f}-",
+                                     dir=tempdir)
+        snippets_dir = tempfile.mkdtemp(prefix=f"snippets-cam{cam:02.0f}-",
+                                        dir=tempdir)
+
+        try:
+            for camera_dirs in rows_camera_dirs.values():
+                if cam in camera_dirs:
+                    for path in filter_files(camera_dirs[cam], ext="ppm"):
+                        link_or_copy(path,
+                                     normpath(f"{batch_dir}/{filename(path)}"))
+
+            log(f"   Estimating (cam {cam:02.0f}) "
+                f"[{len(rows_camera_dirs)} signs]...")
+            self.run_openpose(batch_dir, snippets_dir)
+        finally:
+            delete_dir(batch_dir)
+        return snippets_dir
+
+    def get_snippets(self, snippets_dir, basename):
+        snippets = sorted(
+            filter_files(snippets_dir, name=f"{basename}_*", ext="json"))
+        assert (len(snippets) > 0), "Failed to estimate snippets."
+        return snippets
 
     def run_openpose(self, dir, snippets_dir):
         command = self.openpose
@@ -152,97 +301,239 @@ class Skeletor(Processor):
             raise e
 
     def pack_and_save_snippets(self, cam_snippets, mode_paths, row):
+        # Snippets of each camera are read only once, for all the modes:
+        cameras = set([
+            cam for mode in mode_paths for cam in self.MODE_CAMERAS[mode]
+            if cam in cam_snippets
+        ])
+        cam_frames = {
+            cam: self.stack_frames(
+                self.create_frames_from_snippets(cam_snippets[cam]))
+            for cam in sorted(cameras)
+        }
+
         for mode, path in mode_paths.items():
             log(f"   Packing ({mode})...")
             properties = self.get_properties(row, mode)
 
-            # Pack snippets into single data and save:
-            data = self.pack_snippets(cam_snippets, properties, mode)
+            # Pack frames into single data and save:
             create_if_missing(directory(path))
-            save_json(data, path)
 
-    def pack_snippets(self, cams_snippets, properties, mode="2d"):
+            if self.storage_format == "npz":
+                frames = self.select_frames(cam_frames, mode)
+                frame_index = (frames['frame_index']
+                               if frames is not None else [])
+                save_skeleton_arrays(properties, frame_index,
+                                     self.get_parts_arrays(frames), path)
+            else:
+                data = self.pack_frames(cam_frames, properties, mode)
+                save_json(data, path)
+            self.mark_done(path, self.get_row_fingerprint(row, mode))
+
+    def get_row_fingerprint(self, row, mode):
+        """
+        Return the fingerprint of the skeleton of the sign in the `mode`,
+        produced from the frames of its cameras and with its metadata.
+        """
+        camera_dirs = [
+            create_filename(base=row.basename, camera=cam, dir=self.input_dir)
+            for cam in self.MODE_CAMERAS[mode]
+        ]
+        return self.get_fingerprint(camera_dirs,
+                                    self.get_properties(row, mode))
+
+    def pack_frames(self, cam_frames, properties, mode="2d"):
+        frames = self.select_frames(cam_frames, mode)
+
+        packed_data = dict(properties)
+        packed_data["frames"] = (self.serialize_frames(frames)
+                                 if frames is not None else [])
+        return packed_data
+
+    def select_frames(self, cam_frames, mode="2d"):
+        """
+        Select the stacked frames of the cameras for the `mode` (merging them
+        into 3D, if the case).
+        """
         assert (mode is not None), "`Mode` must be informed"
 
-        def validate_mapping(cams_snippets, required_size, mode):
+        def validate_mapping(cam_frames, required_size, mode):
             assert (
-                len(cams_snippets) >= required_size
-            ), f"Camera x snippets mapping size is not compatible with '{mode}' mode"
+                len(cam_frames) >= required_size
+            ), f"Camera x frames mapping size is not compatible with '{mode}' mode"
 
         if mode == "2d":
-            validate_mapping(cams_snippets, 1, mode)
-            frames = self.create_frames_from_snippets(cams_snippets[1])
+            validate_mapping(cam_frames, 1, mode)
+            frames = cam_frames[1]
         elif mode == "3d":
-            validate_mapping(cams_snippets, 2, mode)
-            frames_cam1 = self.create_frames_from_snippets(cams_snippets[1])
-            frames_cam2 = self.create_frames_from_snippets(cams_snippets[2])
-            frames = self.merge_frames_into_3d(frames_cam1, frames_cam2)
+            validate_mapping(cam_frames, 2, mode)
+            frames = self.merge_frames_into_3d(cam_frames[1], cam_frames[2])
         else:
-            frames = []
+            frames = None
+        return frames
 
-        packed_data = copy.deepcopy(properties)
-        packed_data["frames"] = frames
-        return packed_data
+    def stack_frames(self, frames):
+        """
+        Stack the `frames` into arrays per part, of shape `(T, N, 3)`, along
+        with their `frame_index`.
+        """
+        return {
+            'frame_index': np.array([frame['frame_index'] for frame in frames],
+                                    dtype=int),
+            'skeleton': {
+                part: np.stack([frame['skeleton'][part] for frame in frames])
+                if frames else np.empty((0, 0, 3))
+                for part in self.PARTS_MAPPING.values()
+            }
+        }
 
     def merge_frames_into_3d(self, frames_cam1, frames_cam2):
-        assert (
-            len(frames_cam1) == len(frames_cam2)
-        ), "The length of the frames from camera 1 and 2 must be equal."
-        merged_frames = list()
-
-        for frame_cam1, frame_cam2 in zip(frames_cam1, frames_cam2):
-            frame = copy.deepcopy(frame_cam1)
-
-            for part in self.PARTS_MAPPING.values():
-                frame['skeleton'][part]["z"] = frame_cam2['skeleton'][part][
-                    "x"]
-                frame['skeleton'][part]["score"] = [
-                    (score_cam1 + score_cam2) / 2
-                    for (score_cam1, score_cam2
-                         ) in zip(frame_cam1['skeleton'][part]["score"],
-                                  frame_cam2['skeleton'][part]["score"])
-                ]
-            merged_frames.append(frame)
-        return merged_frames
+        """
+        Merge the stacked frames of cameras 1 and 2 into 3D coordinates, in
+        which 'z' is the 'x' of camera 2 and the scores are averaged. Frames
+        are aligned by their `frame_index`, discarding those missing in any
+        of the cameras.
+        """
+        frame_index, idx_cam1, idx_cam2 = np.intersect1d(
+            frames_cam1['frame_index'], frames_cam2['frame_index'],
+            return_indices=True)
+
+        if len(frame_index) < max(len(frames_cam1['frame_index']),
+                                  len(frames_cam2['frame_index'])):
+            log("   Discarding frames not estimated in both cameras...", 2)
+
+        def align(coordinates, idx):
+            # Avoid copying when frames are already aligned:
+            if np.array_equal(idx, np.arange(len(coordinates))):
+                return coordinates
+            return coordinates[idx]
+
+        skeleton = dict()
+
+        for part in self.PARTS_MAPPING.values():
+            coords_cam1 = align(frames_cam1['skeleton'][part], idx_cam1)
+            coords_cam2 = align(frames_cam2['skeleton'][part], idx_cam2)
+            assert (
+                coords_cam1.shape == coords_cam2.shape
+            ), f"Incompatible sizes between cameras 1 and 2 for the '{part}'."
+
+            # Columns 'x', 'y', 'z' (the 'x' of camera 2) and 'score':
+            merged = np.empty(coords_cam1.shape[:2] + (4, ))
+            merged[..., :2] = coords_cam1[..., :2]
+            merged[..., 2] = coords_cam2[..., 0]
+            merged[..., 3] = (coords_cam1[..., 2] + coords_cam2[..., 2]) / 2
+            skeleton[part] = merged
+        return {'frame_index': frame_index, 'skeleton': skeleton}
 
     def create_frames_from_snippets(self, snippets):
-        frames = list()
+        from concurrent.futures import ThreadPoolExecutor
 
         def get_frame_index(path):
             return int(filename(path, False).split("_")[-2])
 
-        for path in snippets:
-            data = read_json(path)
-            frame = {'frame_index': get_frame_index(path), 'skeleton': {}}
-
+        def create_frame(path, data):
             # Consider only first person:
             person = data['people'][0]
 
-            for src_part, tgt_part in self.PARTS_MAPPING.items():
-                frame['skeleton'][tgt_part] = self.create_coordinates(
-                    tgt_part, person[src_part])
-            frames.append(frame)
-        return frames
+            return {
+                'frame_index': get_frame_index(path),
+                'skeleton': {
+                    tgt_part: self.create_coordinates(tgt_part,
+                                                      person[src_part])
+                    for src_part, tgt_part in self.PARTS_MAPPING.items()
+                }
+            }
 
-    def create_coordinates(self, part, keypoints):
-        x = list()
-        y = list()
-        score = list()
-        name = list()
+        # Snippets are small files, thus read concurrently:
+        with ThreadPoolExecutor(max_workers=self.read_workers) as pool:
+            return [
+                create_frame(path, data)
+                for path, data in zip(snippets, pool.map(read_json, snippets))
+            ]
 
-        # Read coordinates:
-        for i in range(0, len(keypoints), 3):
-            x.append(keypoints[i])
-            y.append(keypoints[i + 1])
-            score.append(keypoints[i + 2])
+    def create_coordinates(self, part, keypoints):
+        """
+        Reshape the flat `keypoints` (`[x, y, score, ...]`) of the `part` into
+        an array of shape `(N, 3)`, with columns 'x', 'y' and 'score'.
+        """
+        coordinates = np.array(keypoints, dtype=float).reshape(-1, 3)
 
         # Get part names:
-        if (x and y and score):
-            name = self.KEYPOINTS[part]
+        name = self.KEYPOINTS[part] if len(coordinates) else []
 
         assert (
-            len(name) == len(x) == len(y) == len(score)
-        ), f"Incompatible sizes between coordinates and parts names for the '{part}' (name: {len(name)}, x: {len(x)}, y: {len(y)}, score: {len(score)})."
+            len(name) == len(coordinates)
+        ), (f"Incompatible sizes between coordinates and parts names for the "
+            f"'{part}' (name: {len(name)}, coordinates: {len(coordinates)}).")
+        return coordinates
+
+    def serialize_frames(self, frames):
+        """
+        Convert the stacked `frames` into the list of frames of the JSON
+        layout.
+        """
+        parts = {
+            part: self.serialize_coordinates(part, coordinates)
+            for part, coordinates in frames['skeleton'].items()
+        }
+        return [{
+            'frame_index': int(frame_index),
+            'skeleton': {
+                part: {
+                    key: (values if key == "name" else values[t])
+                    for key, values in data.items()
+                }
+                for part, data in parts.items()
+            }
+        } for t, frame_index in enumerate(frames['frame_index'])]
 
-        # Return data:
-        return {"name": name, "score": score, "x": x, "y": y}
+    def get_parts_arrays(self, frames):
+        """
+        Convert the stacked `frames` into the arrays per part of the binary
+        layout (names, columns and coordinates).
+        """
+        if frames is None:
+            return dict()
+
+        return {
+            part: (self.KEYPOINTS[part] if coordinates.shape[1] else [],
+                   (self.COLUMNS_3D
+                    if coordinates.shape[-1] == 4 else self.COLUMNS_2D),
+                   coordinates)
+            for part, coordinates in frames['skeleton'].items()
+        }
+
+    def serialize_coordinates(self, part, coordinates):
+        """
+        Convert the stacked `coordinates` of the `part` into the lists (per
+        frame) of the JSON layout (`name`, `score`, `x`, `y` and, in 3D, `z`).
+        """
+        columns = (self.COLUMNS_3D
+                   if coordinates.shape[-1] == 4 else self.COLUMNS_2D)
+        values = {
+            column: coordinates[..., i]
+            for i, column in enumerate(columns)
+        }
+        data = {
+            "name": self.KEYPOINTS[part] if coordinates.shape[1] else [],
+            # Averaged scores (in 3D) are always real numbers:
+            "score": self.to_numbers(values["score"],
+                                     as_float=("z" in values)),
+            "x": self.to_numbers(values["x"]),
+            "y": self.to_numbers(values["y"])
+        }
+        if "z" in values:
+            data["z"] = self.to_numbers(values["z"])
+        return data
+
+    def to_numbers(self, values, as_float=False):
+        """
+        Convert the `values` into a list of numbers, in which integral values
+        are `int` (as written by OpenPose), unless `as_float`.
+        """
+        numbers = values.astype(object)
+
+        if not as_float:
+            is_integral = (np.mod(values, 1) == 0)
+            numbers[is_integral] = values[is_integral].astype(np.int64)
+        return numbers.tolist()
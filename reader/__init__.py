@@ -1 +1,3 @@
 from .json_reader import *
+from .vid_reader import *
+from .dataset_reader import *
@@ -0,0 +1,280 @@
+import io
+import json
+import os
+import struct
+import zipfile
+
+import numpy as np
+from commons.util import exists, filter_files, normpath, read_json, save_json
+from utils import (MODE_CAMERAS, SKELETON_FORMATS, ShardStore,
+                   skeleton_from_arrays, skeleton_to_arrays)
+
+
+class FileWindow(io.RawIOBase):
+    """
+    Read-only view of the `size` bytes of the file `f` from `offset` on, as
+    if they were a file by themselves (e.g., a file inside a shard).
+    """
+    def __init__(self, f, offset, size):
+        self._f = f
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        base = {
+            io.SEEK_SET: 0,
+            io.SEEK_CUR: self._pos,
+            io.SEEK_END: self._size
+        }[whence]
+        self._pos = max(0, base + pos)
+        return self._pos
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), self._size - self._pos))
+
+        if count:
+            self._f.seek(self._offset + self._pos)
+            count = self._f.readinto(memoryview(buffer)[:count])
+            self._pos += count
+        return count
+
+
+class DatasetReader:
+    """
+    Random-access reader of the signs generated by a phase, either as
+    per-sign files (JSON or NPZ, in a directory per mode) or packed into
+    shards by the `pack` phase.
+
+    The directory is indexed once (basename, mode, label, consultant,
+    session, scene and number of frames of each sign), and the index is
+    saved in `index_path` for the next runs (by default, next to the
+    directory, so that it is not taken as an output of its phase). Signs are
+    only read when retrieved, and the arrays of NPZ files are memory-mapped.
+    """
+    INDEX_FILE = "dataset-index.json"
+    PROPERTIES = ["label", "consultant", "session", "scene"]
+
+    def __init__(self, dir, index_path=None, refresh=False):
+        self.dir = normpath(dir)
+        self.index_path = normpath(index_path
+                                   or f"{self.dir}-{self.INDEX_FILE}")
+
+        if exists(self.index_path) and not refresh:
+            self.entries = read_json(self.index_path)
+        else:
+            self.entries = self.create_index()
+            self.save_index()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def create_index(self):
+        """
+        Index the signs of the directory, reading only those which are new
+        or changed since the last index.
+        """
+        def get_location(entry):
+            return (entry["path"], entry["offset"], entry["size"],
+                    entry["mtime"])
+
+        last_entries = {
+            get_location(entry): entry
+            for entry in (read_json(self.index_path)
+                          if exists(self.index_path) else [])
+        }
+        entries = list()
+
+        for entry in self.__list_files():
+            key = get_location(entry)
+
+            if key in last_entries:
+                entries.append(last_entries[key])
+            else:
+                entry.update(self.__read_properties(entry))
+                entries.append(entry)
+        return sorted(entries, key=lambda e: (e["mode"], e["basename"]))
+
+    def save_index(self):
+        # Replace the index at once, so that it is never read incomplete:
+        tmp_path = f"{self.index_path}.tmp"
+        save_json(self.entries, tmp_path)
+        os.replace(tmp_path, self.index_path)
+
+    def query(self, **filters):
+        """
+        Return the entries matching all the `filters`, by property. Filters
+        are values, collections of accepted values or predicates.
+        """
+        def matches(value, accepted):
+            if callable(accepted):
+                return accepted(value)
+            elif isinstance(accepted, (list, tuple, set)):
+                return value in accepted
+            return value == accepted
+
+        return [
+            entry for entry in self.entries
+            if all([matches(entry.get(name), accepted)
+                    for name, accepted in filters.items()])
+        ]
+
+    def get_entry(self, basename, mode):
+        entries = self.query(basename=basename, mode=mode)
+
+        if not entries:
+            raise Exception(f"Sign `{basename}` ({mode}) not found.")
+        return entries[0]
+
+    def get_data(self, entry):
+        """
+        Read the sign of the `entry` into the JSON layout.
+        """
+        if entry["format"] == "npz":
+            return skeleton_from_arrays(*self.get_arrays(entry))
+
+        with open(self.__get_path(entry), "rb") as f:
+            f.seek(entry["offset"])
+            return json.loads(f.read(entry["size"]))
+
+    def get_arrays(self, entry):
+        """
+        Read the sign of the `entry` into its properties, the indexes of its
+        frames and the keypoints per part (as in `skeleton_to_arrays`).
+        Arrays of NPZ files are memory-mapped, instead of read.
+        """
+        if entry["format"] != "npz":
+            return skeleton_to_arrays(self.get_data(entry))
+
+        path = self.__get_path(entry)
+
+        with open(path, "rb") as f:
+            window = FileWindow(f, entry["offset"], entry["size"])
+
+            with zipfile.ZipFile(window) as content:
+                header = self.__read_header(content)
+                frame_index = np.lib.format.read_array(
+                    content.open("frame_index.npy"))
+                parts = {
+                    part: (info["name"], info["columns"],
+                           self.__map_array(content, window, f"part_{part}",
+                                            path, entry["offset"]))
+                    for part, info in header["parts"].items()
+                }
+        return header["properties"], frame_index, parts
+
+    def __get_path(self, entry):
+        return normpath(f"{self.dir}/{entry['path']}")
+
+    def __list_files(self):
+        """
+        List the signs of the directory, as entries with their location
+        (path, offset, size and modification time) and format. Files in
+        shards are never modified, as these are only appended.
+        """
+        if exists(normpath(f"{self.dir}/{ShardStore.INDEX_FILE}")):
+            store = ShardStore(self.dir)
+            return [{
+                "basename": key.split("/", 1)[1],
+                "mode": key.split("/", 1)[0],
+                "path": item["shard"],
+                "offset": item["offset"],
+                "size": item["size"],
+                "format": item["ext"],
+                "mtime": None
+            } for key, item in store.index["entries"].items()]
+
+        entries = list()
+
+        for fmt in SKELETON_FORMATS:
+            for path in filter_files(self.dir, ext=fmt):
+                path = normpath(path)
+
+                if not self.__is_sign_file(path):
+                    continue
+
+                rel_path = os.path.relpath(path, self.dir)
+                entries.append({
+                    "basename": os.path.splitext(os.path.basename(path))[0],
+                    "mode": os.path.basename(os.path.dirname(path)),
+                    "path": rel_path,
+                    "offset": 0,
+                    "size": os.path.getsize(path),
+                    "format": fmt,
+                    "mtime": os.path.getmtime(path)
+                })
+        return entries
+
+    def __is_sign_file(self, path):
+        """
+        Whether the file in `path` is a sign (i.e., directly in the directory
+        of a mode, and not an index).
+        """
+        rel_dir = os.path.relpath(os.path.dirname(path), self.dir)
+        return (rel_dir in MODE_CAMERAS) and (path != self.index_path) and (
+            os.path.basename(path) != self.INDEX_FILE)
+
+    def __read_properties(self, entry):
+        if entry["format"] == "npz":
+            properties, frame_index, _ = self.get_arrays(entry)
+            num_frames = len(frame_index)
+        else:
+            properties = self.get_data(entry)
+            num_frames = len(properties.get("frames", []))
+
+        values = {name: properties.get(name) for name in self.PROPERTIES}
+        values["frames"] = num_frames
+
+        # Mode of the data takes precedence over that of the directory:
+        if properties.get("mode"):
+            values["mode"] = properties["mode"]
+        return values
+
+    def __read_header(self, content):
+        header = np.lib.format.read_array(content.open("header.npy"))
+        return json.loads(str(header))
+
+    def __map_array(self, content, window, name, path, offset):
+        """
+        Memory-map the array `name` of the NPZ `content`, whose data lies
+        uncompressed in the file (otherwise, it is read).
+        """
+        info = content.getinfo(f"{name}.npy")
+
+        if info.compress_type != zipfile.ZIP_STORED:
+            return np.lib.format.read_array(content.open(info))
+
+        # Skip the local header of the member, then the NPY header:
+        window.seek(info.header_offset + 26)
+        name_size, extra_size = struct.unpack("<2H", window.read(4))
+        window.seek(info.header_offset + 30 + name_size + extra_size)
+
+        version = np.lib.format.read_magic(window)
+        read_header = {
+            (1, 0): np.lib.format.read_array_header_1_0,
+            (2, 0): np.lib.format.read_array_header_2_0
+        }.get(version)
+
+        if read_header is None:
+            return np.lib.format.read_array(content.open(info))
+
+        shape, fortran_order, dtype = read_header(window)
+
+        if dtype.hasobject or not np.prod(shape):
+            return np.lib.format.read_array(content.open(info))
+
+        return np.memmap(path, dtype=dtype, mode="r", shape=shape,
+                         order=("F" if fortran_order else "C"),
+                         offset=(offset + window.tell()))
@@ -1,5 +1,8 @@
+from collections.abc import Mapping
+
+import numpy as np
 from commons.model import Coordinate
-from copy import deepcopy
+from constant import KEYPOINTS_COCO
 
 
 class JsonReader:
@@ -14,34 +17,79 @@ class JsonReader:
         pass
 
 
+class KeypointsView(Mapping):
+    """
+    Keypoints of a body part, by name, backed by an array of shape `(N, 4)`
+    (columns `x`, `y`, `z` and `score`). The `Coordinate` of a keypoint is
+    only created when it is accessed.
+    """
+    __slots__ = ["names", "values", "_columns", "_indexes"]
+    COLUMNS = ["x", "y", "z", "score"]
+
+    def __init__(self, names, values, columns, indexes):
+        self.names = names
+        self.values = values
+        self._columns = columns
+        self._indexes = indexes
+
+    def __getitem__(self, name):
+        row = self.values[self._indexes[name]].tolist()
+        x, y, z, score = [
+            value if present else None
+            for value, present in zip(row, self._columns)
+        ]
+        return Coordinate(x, y, z, score, name)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
 class AsllvdSkeletonReader(JsonReader):
     """
     Reader for the `ASLLVD Skeleton` JSON layout
     """
+    def __init__(self, json, parts):
+        super().__init__(json, parts)
+
+        # Indexes of the keypoints names, resolved once per part:
+        self._indexes = {
+            part: {name: i
+                   for i, name in enumerate(KEYPOINTS_COCO[part])}
+            for part in parts if part in KEYPOINTS_COCO
+        }
+
     def get_data(self, person=0):
-        data = deepcopy(self._raw)
+        # The raw data is not modified, so only the frames are rebuilt:
+        data = dict(self._raw)
         frames = sorted(data["frames"], key=lambda x: x["frame_index"])
         frames = [self.__get_parts_coordinates(frame) for frame in frames]
         data["frames"] = frames
         return data
 
     def __get_parts_coordinates(self, frame):
-        new_frame = deepcopy(frame)
-
-        def get_property(new_frame, part, prop, i):
-            return (new_frame["skeleton"][part][prop][i]) if (
-                prop in new_frame["skeleton"][part]) else None
+        new_frame = dict(frame)
 
         if "skeleton" in new_frame:
+            new_frame["skeleton"] = dict(new_frame["skeleton"])
+
             for part in self._parts:
-                points = len(new_frame["skeleton"][part]["score"])
-                new_frame["skeleton"][part] = {
-                    new_frame["skeleton"][part]["name"][i]:
-                    Coordinate(get_property(new_frame, part, "x", i),
-                               get_property(new_frame, part, "y", i),
-                               get_property(new_frame, part, "z", i),
-                               get_property(new_frame, part, "score", i),
-                               get_property(new_frame, part, "name", i))
-                    for i in range(points)
-                }
+                new_frame["skeleton"][part] = self.__get_keypoints(
+                    part, new_frame["skeleton"][part])
         return new_frame
+
+    def __get_keypoints(self, part, keypoints):
+        names = keypoints["name"]
+        columns = [column in keypoints for column in KeypointsView.COLUMNS]
+        values = np.array([
+            keypoints[column] if present else [0] * len(names)
+            for column, present in zip(KeypointsView.COLUMNS, columns)
+        ], dtype=float).reshape(len(columns), len(names)).T
+
+        if names == KEYPOINTS_COCO.get(part):
+            indexes = self._indexes[part]
+        else:
+            indexes = {name: i for i, name in enumerate(names)}
+        return KeypointsView(names, values, columns, indexes)
@@ -0,0 +1,237 @@
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+
+class VidReader:
+    """
+    Reader for the ASLLVD `.vid` video container, with random access to the
+    frames of a memory-mapped file.
+
+    The container starts with a header (width, height and number of frames),
+    followed by the offsets of the frames, each one compressed with `zlib`.
+    Frames are stored as RGB (when the number of frames is negative), or as
+    raw Bayer data of 8 or 16 bits, which is demosaiced as in `vidReader`.
+
+    Frames are numbered from 1, as in `vidReader`.
+    """
+    HEADER = struct.Struct("<HHi")
+    OFFSET = struct.Struct("<Q")
+    WIDTH_8BITS = 0x8fff
+
+    # Bayer tiles of the 16-bit frames, indexed by '(y % 2) * 2 + (x % 2)':
+    TILE_16BITS = {1600: "grbG"}
+    TILE_16BITS_DEFAULT = "bGgr"
+    BALANCE_16BITS = np.array([1.0, 1.33, 3.05], dtype=np.float32)
+    SCALE_16BITS = np.float32(4.0)
+    CORRELATION = 1.1
+
+    # Bayer tile of the 8-bit frames (`BAYER_TILE_GBRG` of `libgphoto2`):
+    TILE_8BITS = "GRBG"
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        width, self.height, num_frames = self.HEADER.unpack_from(self._mmap)
+
+        if width > self.WIDTH_8BITS:
+            self.width = width - self.WIDTH_8BITS
+            self.bits = 8
+        else:
+            self.width = width
+            self.bits = 16
+
+        self.is_rgb = num_frames < 0
+        self.num_frames = abs(num_frames)
+        self._offsets = [
+            self.OFFSET.unpack_from(self._mmap, (i + 1) * self.OFFSET.size)[0]
+            for i in range(self.num_frames)
+        ] + [len(self._mmap)]
+
+    def __len__(self):
+        return self.num_frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def get_payload(self, frame):
+        """
+        Return the compressed data of the `frame`, as a view of the file.
+        """
+        if not (1 <= frame <= self.num_frames):
+            raise Exception(f"Frame {frame} is out of range "
+                            f"[1 ~ {self.num_frames}].")
+        start = self._offsets[frame - 1]
+        end = self._offsets[frame]
+        return np.frombuffer(self._mmap, dtype=np.uint8, count=(end - start),
+                             offset=start)
+
+    def get_frame(self, frame):
+        """
+        Return the `frame` as an RGB array of shape `(height, width, 3)`.
+        """
+        payload = self.get_payload(frame)
+        shape = (self.height, self.width)
+
+        if payload.size == 0:
+            return self.get_blank_frame()
+
+        raw = zlib.decompress(payload)
+
+        if self.is_rgb:
+            return np.frombuffer(raw, dtype=np.uint8).reshape(shape + (3, ))
+        elif self.bits == 8:
+            return self.__demosaic_8bits(
+                np.frombuffer(raw, dtype=np.uint8).reshape(shape))
+        else:
+            return self.__demosaic_16bits(
+                np.frombuffer(raw, dtype="<u2").reshape(shape))
+
+    def get_blank_frame(self):
+        return np.zeros((self.height, self.width, 3), dtype=np.uint8)
+
+    def iter_frames(self, frames):
+        for frame in frames:
+            yield frame, self.get_frame(frame)
+
+    def save_frame(self, frame, path):
+        """
+        Save the `frame` as a PPM image in `path`.
+        """
+        self.save_image(self.get_frame(frame), path)
+
+    def save_image(self, image, path):
+        """
+        Save the RGB `image` as a PPM image in `path`.
+        """
+        with open(path, "wb") as f:
+            f.write(f"P6\n{image.shape[1]} {image.shape[0]}\n255\n".encode())
+            f.write(image.tobytes())
+
+    def __get_tile_masks(self, tile):
+        y, x = np.indices((self.height, self.width))
+        index = (y % 2) * 2 + (x % 2)
+        return {
+            colour: np.isin(index, [i for i, c in enumerate(tile) if c == colour])
+            for colour in set(tile)
+        }
+
+    def __demosaic_8bits(self, raw):
+        """
+        Interpolation of `libgphoto2` (`gp_bayer_decode`): lateral colours are
+        averaged, while crossed and diagonal ones discard the outlier
+        neighbour (and green follows horizontal or vertical edges).
+        """
+        h, w = raw.shape
+        masks = self.__get_tile_masks(self.TILE_8BITS)
+        values = np.pad(raw.astype(np.int64), 1)
+        inside = np.pad(np.ones(raw.shape, dtype=bool), 1)
+
+        def at(offsets):
+            return (np.stack([values[1 + dy:1 + dy + h, 1 + dx:1 + dx + w]
+                              for dy, dx in offsets]),
+                    np.stack([inside[1 + dy:1 + dy + h, 1 + dx:1 + dx + w]
+                              for dy, dx in offsets]))
+
+        def average(offsets):
+            neighbours, valid = at(offsets)
+            return neighbours.sum(axis=0) // valid.sum(axis=0)
+
+        def accrue(offsets, is_green=False):
+            neighbours, valid = at(offsets)
+            count = valid.sum(axis=0)
+            mean = neighbours.sum(axis=0) // count
+
+            # Discard the neighbour which is far from the others:
+            above = valid & (neighbours > mean)
+            num_above = above.sum(axis=0)
+            selected = np.where(num_above == 3, above, ~above)
+            result = np.where(
+                (count < 4) | (num_above == 0) | (num_above == 2), mean,
+                (neighbours * selected).sum(axis=0) // 3)
+
+            if is_green:
+                v0, v1, v2, v3 = neighbours
+                diff_h, diff_v = (v1 - v0)**2, (v3 - v2)**2
+                result = np.select(
+                    [(count == 4) & (diff_h > 2 * diff_v),
+                     (count == 4) & (diff_v > 2 * diff_h)],
+                    [(v2 + v3) // 2, (v0 + v1) // 2], result)
+            return result
+
+        CROSS = [(0, -1), (0, 1), (-1, 0), (1, 0)]
+        DIAGONAL = [(1, 1), (-1, -1), (1, -1), (-1, 1)]
+        HORIZONTAL = [(0, 1), (0, -1)]
+        VERTICAL = [(1, 0), (-1, 0)]
+
+        # Greens of the red rows are those with red pixels laterally:
+        is_red, is_blue = masks["R"], masks["B"]
+        is_green_red = masks["G"] & np.any(is_red, axis=1)[:, None]
+        is_green_blue = masks["G"] & ~is_green_red
+        raw = raw.astype(np.int64)
+
+        red = np.select([is_red, is_blue, is_green_red, is_green_blue],
+                        [raw, accrue(DIAGONAL), average(HORIZONTAL),
+                         average(VERTICAL)])
+        green = np.where(is_red | is_blue, accrue(CROSS, True), raw)
+        blue = np.select([is_blue, is_red, is_green_blue, is_green_red],
+                         [raw, accrue(DIAGONAL), average(HORIZONTAL),
+                          average(VERTICAL)])
+        return np.stack([red, green, blue], axis=-1).astype(np.uint8)
+
+    def __demosaic_16bits(self, raw):
+        """
+        Edge-directed interpolation of `vidReader`, followed by white balance.
+        """
+        h, w = raw.shape
+        tile = self.TILE_16BITS.get(w, self.TILE_16BITS_DEFAULT)
+        masks = self.__get_tile_masks(tile)
+        values = raw.astype(np.int64)
+
+        def neighbours(n, size):
+            i = np.arange(size)
+            return {
+                -1: np.where(i > 0, i - 1, i + 1),
+                -2: np.where(i > 1, i - 2, i),
+                1: np.where(i < size - 1, i + 1, i - 1),
+                2: np.where(i < size - 2, i + 2, i)
+            }[n]
+
+        def at(dy, dx):
+            rows = neighbours(dy, h) if dy else np.arange(h)
+            cols = neighbours(dx, w) if dx else np.arange(w)
+            return values[np.ix_(rows, cols)]
+
+        horizontal = (at(0, -1) + at(0, 1)) >> 1
+        vertical = (at(-1, 0) + at(1, 0)) >> 1
+        cross = (at(0, -1) + at(0, 1) + at(-1, 0) + at(1, 0)) >> 2
+        diagonal = (at(-1, -1) + at(-1, 1) + at(1, -1) + at(1, 1)) >> 2
+
+        # Interpolate green along the direction of the smallest gradient:
+        grad_x = np.abs(at(0, -2) - at(0, 2))
+        grad_y = np.abs(at(-2, 0) - at(2, 0))
+        green = np.where(grad_x > self.CORRELATION * grad_y, vertical,
+                         np.where(grad_y > self.CORRELATION * grad_x,
+                                  horizontal, cross))
+
+        is_red, is_blue = masks["r"], masks["b"]
+        is_green_red, is_green_blue = masks["g"], masks["G"]
+        red = np.select([is_red, is_blue, is_green_red, is_green_blue],
+                        [values, diagonal, horizontal, vertical])
+        green = np.where(is_red | is_blue, green, values)
+        blue = np.select([is_blue, is_red, is_green_blue, is_green_red],
+                         [values, diagonal, horizontal, vertical])
+
+        rgb = np.stack([red, green, blue], axis=-1).astype(np.float32)
+        rgb = rgb * self.BALANCE_16BITS / self.SCALE_16BITS
+        return np.clip(np.floor(rgb), 0, 255).astype(np.uint8)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+from commons.log import log
+from commons.util import exists, normpath
+
+from utils import WorkManifest
+
+
+def report(work_dir, phase=None, list_state=None):
+    """
+    Report the progress of the phases in the `work_dir`, from its work
+    manifest (number of items and size of their outputs per state), and,
+    optionally, list the items in the `list_state`.
+    """
+    manifest = open_manifest(work_dir)
+    summary = [
+        row for row in manifest.summarize()
+        if (phase is None) or (row["phase"] == phase)
+    ]
+    groups = dict()
+
+    for row in summary:
+        group = groups.setdefault((row["phase"], row["mode"]), {
+            "size": 0,
+            "updated": 0
+        })
+        group[row["state"]] = row["count"]
+        group["size"] += row["size"]
+        group["updated"] = max(group["updated"], row["updated"])
+
+    header = ["Phase", "Mode"] + [s.capitalize() for s in WorkManifest.STATES
+                                  ] + ["Size (MB)", "Updated"]
+    log(("{:<12}{:<6}" + "{:>10}" * 5 + "  {}").format(*header), 1)
+    log("-" * 92, 1)
+
+    for (phase_name, mode), group in groups.items():
+        values = [group.get(state, 0) for state in WorkManifest.STATES]
+        updated = time.strftime("%Y-%m-%d %H:%M:%S",
+                                time.localtime(group["updated"]))
+        log(("{:<12}{:<6}" + "{:>10}" * 4 + "{:>10.1f}  {}").format(
+            phase_name, mode or "-", *values, group["size"] / (1024**2),
+            updated), 1)
+
+    if list_state:
+        log("", 1)
+        log(f"{list_state.capitalize()} items:", 1)
+
+        for item in manifest.get_items(phase, list_state):
+            log(f"  {item['phase']} | {item['mode'] or '-'} | "
+                f"{item['item']}", 1)
+    manifest.close()
+
+
+def reset(work_dir, phase):
+    """
+    Forget the items of the `phase`, so that the next run records them again
+    from its output directory (e.g., after changing the outputs by hand).
+    """
+    manifest = open_manifest(work_dir)
+    count = manifest.reset(phase)
+    manifest.close()
+    log(f"Removed {count} items of the '{phase}' phase from the manifest.", 1)
+
+
+def open_manifest(work_dir):
+    path = normpath(f"{work_dir}/{WorkManifest.DB_FILE}")
+
+    if not exists(path):
+        raise Exception(f"Work manifest not found: `{path}`.")
+    return WorkManifest(work_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Report the progress of the phases in a work directory')
+    parser.add_argument('work_dir', help='Working directory')
+    parser.add_argument('-p', '--phase', help='Phase to report (defaults '
+                        'to all of them)')
+    parser.add_argument('-l', '--list', dest='list_state',
+                        choices=WorkManifest.STATES,
+                        help='List the items in the state')
+    parser.add_argument('--reset', action='store_true',
+                        help='Forget the items of the phase, to record them '
+                        'again from its outputs on the next run')
+    args = parser.parse_args()
+
+    if args.reset:
+        assert args.phase, "Phase to reset must be informed"
+        reset(args.work_dir, args.phase)
+    else:
+        report(args.work_dir, args.phase, args.list_state)
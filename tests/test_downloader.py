@@ -0,0 +1,178 @@
+import argparse
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from processor.downloader import Downloader
+
+CONTENT = bytes(range(256)) * 64
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the remote server, serving the `content` of the server with
+    support for range requests (`If-Range` by ETag), unless disabled, except
+    for the `missing` paths.
+    """
+    def do_HEAD(self):
+        self.server.probes.append(self.path)
+
+        if self.path in self.server.missing:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_content(with_body=False)
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        self.send_content()
+
+    def send_content(self, with_body=True):
+        content = self.server.content
+        etag = f'"{len(content)}-{content[:8].hex()}"'
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        start = int(match.group(1)) if match else 0
+
+        if match and self.server.ranges and if_range in [None, etag]:
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.end_headers()
+                return
+            end = len(content) - 1
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             f"bytes {start}-{end}/{len(content)}")
+        else:
+            start = 0
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(len(content) - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        if with_body:
+            self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = HTTPServer(("127.0.0.1", 0), FileHandler)
+    server.content = CONTENT
+    server.ranges = True
+    server.requests = list()
+    server.probes = list()
+    server.missing = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(tmp_path):
+    args = argparse.Namespace(work_dir=str(tmp_path),
+                              mode=["2d"],
+                              format=["mov"],
+                              download={"output_dir": "./download"})
+    return Downloader(args)
+
+
+def get_url(server, fmt="mov"):
+    return f"http://127.0.0.1:{server.server_port}/scene1-camera1.{fmt}"
+
+
+def test_resume_truncated_partial(server, downloader, tmp_path):
+    path = tmp_path / "file.part"
+    path.write_bytes(CONTENT[:1000])
+
+    downloader.download_resumable(get_url(server), str(path))
+
+    assert path.read_bytes() == CONTENT
+    assert server.requests[-1]["Range"] == "bytes=1000-"
+
+
+def test_download_again_when_range_is_ignored(server, downloader, tmp_path):
+    server.ranges = False
+    path = tmp_path / "file.part"
+    path.write_bytes(b"x" * 1000)
+
+    downloader.download_resumable(get_url(server), str(path))
+
+    assert path.read_bytes() == CONTENT
+
+
+def test_download_again_when_partial_is_larger(server, downloader, tmp_path):
+    path = tmp_path / "file.part"
+    path.write_bytes(CONTENT + b"x" * 1000)
+
+    downloader.download_resumable(get_url(server), str(path))
+
+    assert path.read_bytes() == CONTENT
+    assert "Range" not in server.requests[-1]
+
+
+def test_keep_complete_partial(server, downloader, tmp_path):
+    path = tmp_path / "file.part"
+    path.write_bytes(CONTENT)
+
+    downloader.download_resumable(get_url(server), str(path))
+
+    assert path.read_bytes() == CONTENT
+
+
+def test_download_again_when_remote_changed(server, downloader, tmp_path):
+    path = tmp_path / "file.part"
+    server.content = CONTENT[:1000]
+    downloader.download_resumable(get_url(server), str(path))
+
+    # Partial of the previous version of the file, with its validator:
+    path.write_bytes(CONTENT[:500])
+    (tmp_path / "file.part.validator").write_text(
+        '{"validator": "\\"1000-0001020304050607\\""}')
+    server.content = CONTENT[::-1]
+
+    downloader.download_resumable(get_url(server), str(path))
+
+    assert path.read_bytes() == CONTENT[::-1]
+    assert server.requests[-1]["If-Range"] == '"1000-0001020304050607"'
+    assert not (tmp_path / "file.part.validator").exists()
+
+
+def test_probe_formats_in_order(server, downloader):
+    fmt_urls = [(fmt, get_url(server, fmt)) for fmt in ["mov", "vid"]]
+
+    assert downloader.probe_first_available(fmt_urls) == fmt_urls[0]
+    assert server.probes == ["/scene1-camera1.mov"]
+
+
+def test_cache_missing_files(server, downloader):
+    server.missing.add("/scene1-camera1.mov")
+    fmt_urls = [(fmt, get_url(server, fmt)) for fmt in ["mov", "vid"]]
+
+    assert downloader.probe_first_available(fmt_urls) == fmt_urls[1]
+    assert downloader.probe_first_available(fmt_urls) == fmt_urls[1]
+    assert server.probes == ["/scene1-camera1.mov", "/scene1-camera1.vid"]
+
+
+def test_do_not_cache_failed_probes(server, downloader):
+    url = get_url(server)
+    server.shutdown()
+    server.server_close()
+
+    assert not downloader.probe_url(url)
+    assert url not in downloader.probe_cache
+
+
+def test_do_not_reserve_unknown_sizes(downloader):
+    downloader.disk_budget = 1
+
+    assert downloader.reserve(1024)
+    assert not downloader.reserve(0)
+    assert downloader.reserved == 1024
@@ -1,2 +1,6 @@
 from .utils import *
 from .args_reader import ArgsReader
+from .shard_store import ShardStore
+from .shared_cache import SharedCache
+from .skeleton_format import *
+from .work_manifest import WorkManifest
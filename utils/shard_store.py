@@ -0,0 +1,160 @@
+import os
+import shutil
+from io import BytesIO
+
+from commons.util import (create_if_missing, exists, normpath, read_json,
+                          save_json)
+
+
+class ShardStore:
+    """
+    Store of files consolidated into a few large shards, with an index of
+    their offsets, so that each file is read with a single seek.
+
+    Files are appended to the last shard until it exceeds `max_size` (in MB),
+    and the index maps their keys to the shard, offset, size and extension.
+    Files added again under the same key leave their previous bytes unused in
+    the shards, until these are compacted.
+    """
+    INDEX_FILE = "index.json"
+    SHARD_FILE = "shard-{:05d}.bin"
+
+    def __init__(self, dir, max_size=None):
+        self.dir = normpath(dir)
+        self.max_size = max_size
+        self.index_path = normpath(f"{self.dir}/{self.INDEX_FILE}")
+        create_if_missing(self.dir)
+
+        self.index = (read_json(self.index_path) if exists(self.index_path)
+                      else {"shards": [], "entries": {}})
+
+    def __contains__(self, key):
+        return key in self.index["entries"]
+
+    def __len__(self):
+        return len(self.index["entries"])
+
+    def keys(self):
+        return self.index["entries"].keys()
+
+    def get_entry(self, key):
+        return self.index["entries"][key]
+
+    def get_shard_path(self, shard):
+        return normpath(f"{self.dir}/{shard}")
+
+    def add(self, key, path):
+        """
+        Append the file in `path` to the last shard, under the `key`.
+        """
+        _, ext = os.path.splitext(path)
+
+        with open(path, "rb") as src:
+            shard, offset, size = self.__append(src)
+
+        self.index["entries"][key] = {
+            "shard": shard,
+            "offset": offset,
+            "size": size,
+            "ext": ext.lstrip(".")
+        }
+
+    def read(self, key):
+        """
+        Read the content of the file of the `key`.
+        """
+        entry = self.get_entry(key)
+
+        with open(self.get_shard_path(entry["shard"]), "rb") as f:
+            f.seek(entry["offset"])
+            return f.read(entry["size"])
+
+    def extract(self, key, path):
+        """
+        Write the file of the `key` back into `path`.
+        """
+        content = self.read(key)
+
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def get_size(self):
+        """
+        Return the size (in bytes) of the shards.
+        """
+        return sum([
+            os.path.getsize(self.get_shard_path(shard))
+            for shard in self.index["shards"]
+            if exists(self.get_shard_path(shard))
+        ])
+
+    def get_unused_size(self):
+        """
+        Return the size (in bytes) of the shards not used by the files in the
+        index (i.e., of the files replaced).
+        """
+        return self.get_size() - sum(
+            [entry["size"] for entry in self.index["entries"].values()])
+
+    def compact(self):
+        """
+        Rewrite the files of the index into new shards, leaving out the unused
+        bytes, and delete the previous shards (once the index is replaced).
+        """
+        def get_location(key_entry):
+            _, entry = key_entry
+            return last_shards.index(entry["shard"]), entry["offset"]
+
+        last_shards = list(self.index["shards"])
+        entries = sorted(self.index["entries"].items(), key=get_location)
+        self.index["shards"] = list()
+
+        for key, entry in entries:
+            shard, offset, size = self.__append(BytesIO(self.read(key)))
+            self.index["entries"][key] = dict(entry,
+                                              shard=shard,
+                                              offset=offset,
+                                              size=size)
+        self.save_index()
+
+        for shard in last_shards:
+            if exists(self.get_shard_path(shard)):
+                os.remove(self.get_shard_path(shard))
+
+    def save_index(self):
+        # Replace the index at once, so that it is never left incomplete:
+        tmp_path = f"{self.index_path}.tmp"
+        save_json(self.index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+
+    def __append(self, src):
+        """
+        Append the content of the file object `src` to the last shard,
+        returning the shard, offset and size.
+        """
+        shard = self.__get_last_shard()
+
+        with open(self.get_shard_path(shard), "ab") as tgt:
+            offset = tgt.seek(0, os.SEEK_END)
+            shutil.copyfileobj(src, tgt)
+            return shard, offset, tgt.tell() - offset
+
+    def __get_last_shard(self):
+        shards = self.index["shards"]
+
+        if shards:
+            path = self.get_shard_path(shards[-1])
+
+            if (self.max_size is None) or (not exists(path)) or \
+                    (os.path.getsize(path) < self.max_size * (1024**2)):
+                return shards[-1]
+
+        # New shards never overwrite existing ones (e.g., when compacting):
+        number = len(shards)
+
+        while exists(self.get_shard_path(self.SHARD_FILE.format(number))):
+            number += 1
+
+        shard = self.SHARD_FILE.format(number)
+        shards.append(shard)
+        return shard
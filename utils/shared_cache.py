@@ -0,0 +1,163 @@
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from hashlib import sha256
+
+from commons.util import (create_if_missing, exists, normpath, read_json,
+                          save_json)
+
+from .utils import link_or_copy
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where files are locked with `msvcrt`, instead:
+    import msvcrt
+    fcntl = None
+
+
+class SharedCache:
+    """
+    Cache of downloaded files, shared among work directories (and jobs),
+    keyed by the hash of their source URL.
+
+    Each entry has a metadata file (URL, size and checksum), and is guarded
+    by a file lock, so that concurrent jobs download it only once. Entries
+    are evicted by least recent use when exceeding `max_size` (in GB).
+    """
+
+    def __init__(self, dir, max_size=None):
+        self.dir = normpath(dir)
+        self.max_size = max_size
+        create_if_missing(self.dir)
+
+    def get_path(self, url):
+        _, ext = os.path.splitext(url)
+        key = sha256(url.encode("utf-8")).hexdigest()
+        return normpath(f"{self.dir}/{key}{ext.lower()}")
+
+    def get_entry(self, url):
+        """
+        Return the metadata of the `url` if cached and intact, or `None`.
+        """
+        path = self.get_path(url)
+        meta_path = f"{path}.json"
+
+        if exists(path) and exists(meta_path):
+            entry = read_json(meta_path)
+
+            if os.path.getsize(path) == entry["size"]:
+                return entry
+        return None
+
+    def restore(self, url, tgt_path):
+        """
+        Place the cached file of the `url` at `tgt_path`, if cached.
+        """
+        with self.__lock(self.get_path(url)):
+            entry = self.get_entry(url)
+
+            if entry is not None:
+                self.__place(self.get_path(url), tgt_path)
+        return entry
+
+    def fetch(self, url, tgt_path, download_fn, checksum_fn):
+        """
+        Place the file of the `url` at `tgt_path`, downloading it to the cache
+        with `download_fn(url, path)` if not cached yet.
+        """
+        path = self.get_path(url)
+
+        with self.__lock(path):
+            entry = self.get_entry(url)
+
+            if entry is None:
+                part_path = f"{path}.part"
+                download_fn(url, part_path)
+                entry = {
+                    "url": url,
+                    "size": os.path.getsize(part_path),
+                    "checksum": checksum_fn(part_path)
+                }
+                shutil.move(part_path, path)
+                save_json(entry, f"{path}.json")
+            self.__place(path, tgt_path)
+
+        self.evict()
+        return entry
+
+    def evict(self):
+        """
+        Remove the least recently used entries (not locked by other jobs)
+        while exceeding the `max_size`.
+        """
+        if self.max_size is None:
+            return
+
+        with self.__lock(f"{self.dir}/.evict"):
+            entries = [
+                normpath(f"{self.dir}/{f}") for f in os.listdir(self.dir)
+                if not f.startswith(".") and not f.endswith(
+                    (".json", ".lock", ".part"))
+            ]
+            entries = sorted(entries, key=os.path.getmtime)
+            size = sum([os.path.getsize(path) for path in entries])
+
+            for path in entries:
+                if size <= self.max_size * (1024**3):
+                    break
+
+                with self.__lock(path, blocking=False) as locked:
+                    if locked:
+                        size -= os.path.getsize(path)
+
+                        for f in [path, f"{path}.json"]:
+                            if exists(f):
+                                os.remove(f)
+
+    def __place(self, path, tgt_path):
+        # Accessing the entry marks it as recently used:
+        os.utime(path)
+
+        if exists(tgt_path):
+            os.remove(tgt_path)
+        link_or_copy(path, tgt_path)
+
+    @contextmanager
+    def __lock(self, path, blocking=True):
+        with open(f"{path}.lock", "a") as f:
+            locked = self.__lock_file(f, blocking)
+
+            try:
+                yield locked
+            finally:
+                if locked:
+                    self.__unlock_file(f)
+
+    def __lock_file(self, f, blocking):
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX |
+                            (0 if blocking else fcntl.LOCK_NB))
+                return True
+            except BlockingIOError:
+                return False
+
+        # Lock on the first byte (`msvcrt` only retries for a few seconds):
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.1)
+
+    def __unlock_file(self, f):
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,164 @@
+import json
+import os
+
+import numpy as np
+from commons.util import exists, read_json, save_json
+
+from .utils import create_filename
+
+SKELETON_FORMATS = ["json", "npz"]
+
+# Columns of the keypoints arrays (those present in the part):
+SKELETON_COLUMNS = ["x", "y", "z", "score"]
+
+
+def get_skeleton_format(path):
+    return os.path.splitext(path)[1].lstrip(".").lower()
+
+
+def find_skeleton_file(base, dir, formats=SKELETON_FORMATS):
+    """
+    Return the path of the skeleton file of the sign `base` in the first of
+    the `formats` found in `dir`, or `None` if missing.
+    """
+    for fmt in formats:
+        path = create_filename(base=base, dir=dir, ext=fmt)
+
+        if exists(path):
+            return path
+    return None
+
+
+def read_skeleton(path):
+    """
+    Read the skeleton file in `path` (JSON or NPZ) into the JSON layout.
+    """
+    if get_skeleton_format(path) == "npz":
+        return skeleton_from_arrays(*read_skeleton_arrays(path))
+    return read_json(path)
+
+
+def save_skeleton(data, path):
+    """
+    Save the `data` in the JSON layout into the skeleton file in `path`
+    (JSON or NPZ, according to its extension).
+    """
+    if get_skeleton_format(path) == "npz":
+        save_skeleton_arrays(*skeleton_to_arrays(data), path)
+    else:
+        save_json(data, path)
+
+
+def read_skeleton_arrays(path):
+    """
+    Read the NPZ skeleton file in `path`, returning the properties of the
+    sign, the indexes of its frames and the keypoints per part, as in
+    `skeleton_to_arrays`.
+    """
+    with np.load(path) as content:
+        header = json.loads(str(content["header"]))
+        frame_index = content["frame_index"]
+        parts = {
+            part: (info["name"], info["columns"], content[f"part_{part}"])
+            for part, info in header["parts"].items()
+        }
+    return header["properties"], frame_index, parts
+
+
+def save_skeleton_arrays(properties, frame_index, parts, path):
+    """
+    Save the sign into the NPZ skeleton file in `path`, with a header
+    (properties, and names and columns of the keypoints of each part) and
+    an array of shape `(T, N, C)` per part.
+    """
+    header = {
+        "properties": properties,
+        "parts": {
+            part: {
+                "name": list(names),
+                "columns": list(columns)
+            }
+            for part, (names, columns, _) in parts.items()
+        }
+    }
+    arrays = {
+        f"part_{part}": values
+        for part, (_, _, values) in parts.items()
+    }
+    with open(path, "wb") as f:
+        np.savez(f, header=np.array(json.dumps(header)),
+                 frame_index=np.asarray(frame_index, dtype=np.int64),
+                 **arrays)
+
+
+def skeleton_to_arrays(data):
+    """
+    Convert the `data` in the JSON layout into its properties, the indexes
+    of the frames and, per part, a tuple with the names of the keypoints,
+    the columns and an array of shape `(T, N, C)`.
+    """
+    if "frames" not in data:
+        raise Exception("Data is not in the skeleton layout.")
+
+    properties = {key: value for key, value in data.items() if key != "frames"}
+    frames = data["frames"]
+
+    for frame in frames:
+        if set(frame) != {"frame_index", "skeleton"}:
+            raise Exception(
+                f"Unsupported frame keys for arrays: {sorted(frame)}.")
+
+    frame_index = [frame["frame_index"] for frame in frames]
+    part_names = list(frames[0]["skeleton"]) if frames else []
+    parts = dict()
+
+    for part in part_names:
+        keypoints = [frame["skeleton"][part] for frame in frames]
+        names = keypoints[0]["name"]
+        columns = [c for c in SKELETON_COLUMNS if c in keypoints[0]]
+
+        if any([kp["name"] != names for kp in keypoints]):
+            raise Exception(
+                f"Inconsistent keypoints among the frames for the '{part}'.")
+
+        values = np.array([[kp[c] for c in columns] for kp in keypoints],
+                          dtype=float).reshape(len(frames), len(columns),
+                                               len(names))
+        parts[part] = (names, columns, values.transpose(0, 2, 1))
+    return properties, frame_index, parts
+
+
+def skeleton_from_arrays(properties, frame_index, parts):
+    """
+    Convert the arrays of `skeleton_to_arrays` back into the JSON layout.
+    """
+    # Keypoints follow the key order of the JSON layout ('name' and 'score'
+    # first, then the coordinates):
+    def get_columns(columns, values):
+        order = sorted(columns, key=lambda c: c != "score")
+        return {
+            column: values[..., columns.index(column)].tolist()
+            for column in order
+        }
+
+    parts = {
+        part: (names, get_columns(columns, values))
+        for part, (names, columns, values) in parts.items()
+    }
+
+    def get_keypoints(names, columns, t):
+        keypoints = {"name": names}
+        keypoints.update(
+            {column: values[t]
+             for column, values in columns.items()})
+        return keypoints
+
+    data = dict(properties)
+    data["frames"] = [{
+        "frame_index": int(index),
+        "skeleton": {
+            part: get_keypoints(names, columns, t)
+            for part, (names, columns) in parts.items()
+        }
+    } for t, index in enumerate(frame_index)]
+    return data
@@ -94,6 +94,20 @@ def get_camera_dirs_if_all_matched(basename,
     return get_valid_cam_mode_mapping(camera_dirs, modes)
 
 
+def link_or_copy(src, tgt):
+    """
+    Create a hard link of `src` at `tgt`, falling back to a copy when the
+    file system does not support it.
+    """
+    import os
+    import shutil
+
+    try:
+        os.link(src, tgt)
+    except OSError:
+        shutil.copyfile(src, tgt)
+
+
 def create_uid(*fields):
     from hashlib import sha1
     SIZE = 6
@@ -0,0 +1,146 @@
+import sqlite3
+import time
+from threading import Lock
+
+from commons.util import normpath
+
+
+class WorkManifest:
+    """
+    Manifest of the work directory, recording the state of each item (output
+    file or directory of a sign, video, etc.) per phase and mode: pending,
+    done, failed or deleted, along with the size of its output, the times it
+    was first and last updated, and the fingerprint of what it was produced
+    from (inputs and config).
+
+    States are kept in a SQLite database, so that the phases read them in
+    bulk (instead of probing the filesystem for each item) and the progress
+    is reported without scanning the outputs. The default (rollback) journal
+    is kept unless `wal` is enabled, as write-ahead logging requires the
+    database to be on a local file system.
+    """
+    DB_FILE = "manifest.db"
+
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+    DELETED = "deleted"
+    STATES = [PENDING, DONE, FAILED, DELETED]
+
+    def __init__(self, work_dir, wal=False):
+        self.path = normpath(f"{work_dir}/{self.DB_FILE}")
+        self.lock = Lock()
+
+        # Connection is shared among the workers of the phase, so access is
+        # serialized by the lock:
+        self.conn = sqlite3.connect(self.path, timeout=60,
+                                    check_same_thread=False)
+        with self.lock, self.conn:
+            # Databases left in WAL mode are switched back, unless enabled:
+            self.conn.execute(
+                f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS items ("
+                              "item TEXT NOT NULL, "
+                              "phase TEXT NOT NULL, "
+                              "mode TEXT NOT NULL, "
+                              "state TEXT NOT NULL, "
+                              "size INTEGER, "
+                              "created REAL NOT NULL, "
+                              "updated REAL NOT NULL, "
+                              "fingerprint TEXT, "
+                              "PRIMARY KEY (item, phase, mode))")
+
+            # Manifests created before the fingerprints:
+            columns = [
+                row[1] for row in self.conn.execute("PRAGMA table_info(items)")
+            ]
+            if "fingerprint" not in columns:
+                self.conn.execute(
+                    "ALTER TABLE items ADD COLUMN fingerprint TEXT")
+
+    def get_states(self, phase):
+        """
+        Return the states and fingerprints of the items of the `phase`, by
+        `(item, mode)`.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT item, mode, state, fingerprint FROM items "
+                "WHERE phase = ?", (phase, )).fetchall()
+        return {(item, mode): (state, fingerprint)
+                for item, mode, state, fingerprint in rows}
+
+    def get_fingerprint(self, item, phase, mode=""):
+        """
+        Return the fingerprint of the `item` of the `phase`, if produced (even
+        if deleted afterwards).
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT fingerprint FROM items WHERE item = ? AND phase = ? "
+                "AND mode = ? AND state IN (?, ?)",
+                (item, phase, mode or "", self.DONE, self.DELETED)).fetchone()
+        return row[0] if row else None
+
+    def get_items(self, phase=None, state=None):
+        """
+        Return the items (with their phase, mode, state, size, times and
+        fingerprint), optionally filtered by `phase` and `state`.
+        """
+        query = "SELECT * FROM items WHERE (? IS NULL OR phase = ?) " \
+            "AND (? IS NULL OR state = ?) ORDER BY phase, mode, item"
+
+        with self.lock:
+            cursor = self.conn.execute(query, (phase, phase, state, state))
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def set_states(self, phase, items, state):
+        """
+        Record the `state` of the `items` of the `phase`, given as tuples of
+        `(item, mode, size, fingerprint)`. Sizes and fingerprints are kept
+        when not informed.
+        """
+        now = time.time()
+        rows = [(item, phase, mode or "", state, size, now, now, fingerprint)
+                for item, mode, size, fingerprint in items]
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO items (item, phase, mode, state, size, created, "
+                "updated, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (item, phase, mode) DO UPDATE SET "
+                "state = excluded.state, "
+                "size = COALESCE(excluded.size, items.size), "
+                "updated = excluded.updated, "
+                "fingerprint = COALESCE(excluded.fingerprint, "
+                "items.fingerprint)", rows)
+
+    def summarize(self):
+        """
+        Return the number of items and their total size per phase, mode and
+        state.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT phase, mode, state, COUNT(*), "
+                "COALESCE(SUM(size), 0), MAX(updated) FROM items "
+                "GROUP BY phase, mode, state "
+                "ORDER BY phase, mode, state").fetchall()
+        return [
+            dict(zip(["phase", "mode", "state", "count", "size", "updated"],
+                     row)) for row in rows
+        ]
+
+    def reset(self, phase):
+        """
+        Forget the items of the `phase`, so that they are recorded again from
+        its outputs on the next run.
+        """
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM items WHERE phase = ?",
+                                     (phase, )).rowcount
+
+    def close(self):
+        with self.lock:
+            self.conn.close()